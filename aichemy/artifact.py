@@ -0,0 +1,250 @@
+import io
+import json
+import os
+import shutil
+
+import cloudpickle
+import numpy as np
+
+ENSEMBLE_EXTENSION = '.ensemble'
+ENSEMBLE_VERSION = 1
+ENSEMBLE_MANIFEST = 'manifest.json'
+FOREST_ARRAYS = ('nodes', 'values', 'trees')
+
+
+class EnsembleArtifact(object):
+    """All members of an ensemble stored in one directory.
+
+    Every member is stored as lz4 compressed blobs: the pickled model, the
+    sorted calibration scores of each class, its p-value lookup tables and,
+    for nets, the net compiled with TorchScript.
+    The trees of random forests are kept out of the pickle, their node
+    arrays are stored as raw npy files that are memory-mapped when loaded.
+    A json manifest lists the blobs of each member, so loading reads the
+    manifest once and only the blobs that are asked for. Members are loaded
+    lazily and kept once loaded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._models = {}
+        if os.path.isfile(os.path.join(path, ENSEMBLE_MANIFEST)):
+            with open(os.path.join(path, ENSEMBLE_MANIFEST)) as fin:
+                self.manifest = json.load(fin)
+
+            if self.manifest['version'] != ENSEMBLE_VERSION:
+                error_message = f"Unsupported ensemble version ({self.manifest['version']}) of {path}"
+                raise ValueError(error_message)
+        else:
+            self.manifest = {'version': ENSEMBLE_VERSION, 'members': []}
+
+    @classmethod
+    def from_name(cls, models_dir, name, model_type):
+        return cls(os.path.join(models_dir, f"{name}_{model_type}{ENSEMBLE_EXTENSION}"))
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, ENSEMBLE_MANIFEST))
+
+    def __len__(self):
+        return len(self.manifest['members'])
+
+    @property
+    def nr_class(self):
+        nr_classes = {len(member['calibration']) for member in self.manifest['members'] if member['calibration']}
+        if len(nr_classes) > 1:
+            error_message = f"The members of {self.path} are calibrated on different numbers of classes"
+            raise ValueError(error_message)
+        return nr_classes.pop() if nr_classes else 0
+
+    def clear(self):
+        """Removes all members, before an ensemble is built anew."""
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.manifest = {'version': ENSEMBLE_VERSION, 'members': []}
+        self._models = {}
+
+    def save_model(self, iteration, model):
+        model_blob, forest = self._write_model(iteration, model)
+        if forest is not None:
+            self._update(iteration, 'forest', forest)
+        self._update(iteration, 'model', model_blob)
+        self._models.pop(iteration, None)
+
+    def save_calibration(self, iteration, calibration_alphas):
+        self._update(iteration, 'calibration', self._write_calibration(iteration, calibration_alphas))
+
+    def save_tables(self, iteration, arrays):
+        self._update(iteration, 'tables', self._write_tables(iteration, arrays))
+
+    def save_script(self, iteration, data):
+        self._update(iteration, 'script', self._write(f"m{iteration}.script", data))
+
+    def write_member(self, iteration, model, calibration_alphas=(), table_arrays=None, script=None):
+        """Writes the blobs of a member without touching the manifest and
+        returns its manifest entry, for workers that build members in
+        parallel. The process that owns the artifact adds the entries with
+        add_member, so the manifest has a single writer.
+        """
+        model_blob, forest = self._write_model(iteration, model)
+        return {'model': model_blob, 'forest': forest,
+                'calibration': self._write_calibration(iteration, calibration_alphas),
+                'tables': self._write_tables(iteration, table_arrays) if table_arrays is not None else None,
+                'script': self._write(f"m{iteration}.script", script) if script is not None else None}
+
+    def add_member(self, iteration, member):
+        self._pad(iteration)
+        self.manifest['members'][iteration] = member
+        self._write_manifest()
+
+    def has_forests(self):
+        return self.exists() and len(self) > 0 and all(member.get('forest') for member in self.manifest['members'])
+
+    def has_scripts(self):
+        return self.exists() and len(self) > 0 and all(member.get('script') for member in self.manifest['members'])
+
+    def load_model(self, iteration, trees=True):
+        """Returns a member's model. Without trees the trees of a forest
+        are left out, for readers that only use its node arrays.
+        """
+        if iteration not in self._models:
+            self._models[iteration] = cloudpickle.loads(self._read(self._member(iteration)['model']))
+
+        model = self._models[iteration]
+        if trees and self._member(iteration).get('forest') is not None and not hasattr(model.estimators_[0], 'tree_'):
+            _attach_trees(model, *self.map_forest(iteration))
+        return model
+
+    def load_models(self):
+        return [self.load_model(i) for i in range(len(self))]
+
+    def load_calibration(self, iteration):
+        return [np.load(io.BytesIO(self._read(blob))) for blob in self._member(iteration)['calibration']]
+
+    def load_tables(self, iteration):
+        """Returns the arrays of the p-value tables of a member, or None if it has none."""
+        blob = self._member(iteration)['tables']
+        if blob is None:
+            return None
+        with np.load(io.BytesIO(self._read(blob))) as arrays:
+            return {key: arrays[key] for key in arrays.files}
+
+    def load_script(self, iteration):
+        """Returns the saved TorchScript module of a member as bytes."""
+        return self._read(self._member(iteration)['script'])
+
+    def map_forest(self, iteration):
+        """Returns the memory-mapped node arrays of the trees of a forest
+        member: the nodes and values of all trees one after another, and
+        the offset, node count and depth of each tree. The maps of all
+        processes share the page cache.
+        """
+        forest = self._member(iteration)['forest']
+        return tuple(np.load(os.path.join(self.path, forest[key]), mmap_mode='r') for key in FOREST_ARRAYS)
+
+    def _write_forest(self, iteration, model):
+        os.makedirs(self.path, exist_ok=True)
+        states = [estimator.tree_.__getstate__() for estimator in model.estimators_]
+        node_counts = np.array([state['node_count'] for state in states], dtype=np.int64)
+        arrays = {'nodes': np.concatenate([state['nodes'] for state in states]),
+                  'values': np.concatenate([state['values'] for state in states]),
+                  'trees': np.stack([np.cumsum(node_counts) - node_counts, node_counts,
+                                     [state['max_depth'] for state in states]], axis=1).astype(np.int64)}
+
+        # The node arrays are stored raw, so they can be memory-mapped instead of decompressed.
+        forest = {}
+        for key in FOREST_ARRAYS:
+            forest[key] = f"m{iteration}.{key}.npy"
+            np.save(os.path.join(self.path, forest[key]), arrays[key])
+        return forest
+
+    def _member(self, iteration):
+        if iteration >= len(self):
+            error_message = f"The ensemble {self.path} has no member {iteration}"
+            raise ValueError(error_message)
+        return self.manifest['members'][iteration]
+
+    def _update(self, iteration, key, value):
+        self._pad(iteration)
+        self.manifest['members'][iteration][key] = value
+        self._write_manifest()
+
+    def _pad(self, iteration):
+        members = self.manifest['members']
+        while len(members) <= iteration:
+            members.append({'model': None, 'forest': None, 'calibration': [], 'tables': None, 'script': None})
+
+    def _write_manifest(self):
+        # The manifest is replaced at once, so a reader never sees a partly written one.
+        temp_manifest = os.path.join(self.path, f"{ENSEMBLE_MANIFEST}.tmp-{os.getpid()}")
+        with open(temp_manifest, 'w') as fout:
+            json.dump(self.manifest, fout, indent=1)
+        os.replace(temp_manifest, os.path.join(self.path, ENSEMBLE_MANIFEST))
+
+    def _write_model(self, iteration, model):
+        """Writes the pickled model, with the trees of a forest as raw node
+        arrays next to it. Returns the blob of the model and the node array
+        files, or None for other models.
+        """
+        forest = None
+        if _is_forest(model):
+            forest = self._write_forest(iteration, model)
+            data = _dumps_forest_shell(model)
+        else:
+            data = cloudpickle.dumps(model)
+        return self._write(f"m{iteration}.model", data), forest
+
+    def _write_calibration(self, iteration, calibration_alphas):
+        return [self._write(f"m{iteration}.calibration{c}", _array_bytes(alpha_c))
+                for c, alpha_c in enumerate(calibration_alphas)]
+
+    def _write_tables(self, iteration, arrays):
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return self._write(f"m{iteration}.p-values", buffer.getvalue())
+
+    def _write(self, blob, data):
+        import lz4.frame
+
+        os.makedirs(self.path, exist_ok=True)
+        blob = f"{blob}.lz4"
+        with open(os.path.join(self.path, blob), 'wb') as fout:
+            fout.write(lz4.frame.compress(data))
+        return blob
+
+    def _read(self, blob):
+        import lz4.frame
+
+        with open(os.path.join(self.path, blob), 'rb') as fin:
+            return lz4.frame.decompress(fin.read())
+
+
+def _array_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _is_forest(model):
+    return all(hasattr(estimator, 'tree_') for estimator in getattr(model, 'estimators_', [None]))
+
+
+def _dumps_forest_shell(model):
+    """Pickles a forest without the node arrays of its trees."""
+    trees = [estimator.__dict__.pop('tree_') for estimator in model.estimators_]
+    try:
+        return cloudpickle.dumps(model)
+    finally:
+        for estimator, tree in zip(model.estimators_, trees):
+            estimator.tree_ = tree
+
+
+def _attach_trees(model, nodes, values, trees):
+    from sklearn.tree._tree import Tree
+
+    for estimator, (offset, node_count, max_depth) in zip(model.estimators_, trees):
+        # Tree copies the nodes into its own buffers, the maps are only read once.
+        tree = Tree(estimator.n_features_in_, np.atleast_1d(estimator.n_classes_).astype(np.intp),
+                    estimator.n_outputs_)
+        tree.__setstate__({'max_depth': int(max_depth), 'node_count': int(node_count),
+                           'nodes': np.asarray(nodes[offset:offset + node_count]),
+                           'values': np.asarray(values[offset:offset + node_count])})
+        estimator.tree_ = tree
@@ -0,0 +1,167 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from aichemy.classifiers import ClassifierRF, PValueTable, BitEmbedding, bit_indices, conformal_p_values
+from aichemy.forest import FlatForest
+from aichemy.utils import ResultMerger
+
+
+def make_dataframe(nr_rows, nr_features, seed=0):
+    """Returns a random fingerprint dataframe in the layout of read_dataframe."""
+    rng = np.random.default_rng(seed)
+    columns_names = [str(i) for i in range(1, nr_features + 1)]
+    dataframe = pd.DataFrame(rng.integers(0, 2, (nr_rows, nr_features), dtype=np.int8), columns=columns_names)
+    dataframe.insert(0, 'class', rng.integers(0, 2, nr_rows, dtype=np.int8))
+    dataframe.insert(0, 'id', pd.array([f"mol{i}" for i in range(nr_rows)], dtype='string'))
+    return dataframe
+
+
+def _merge_quadratic(chunks):
+    dataframe = pd.DataFrame()
+    for chunk in chunks:
+        dataframe = pd.concat([dataframe, chunk])
+    return dataframe
+
+
+def _merge_collect(chunks):
+    merger = ResultMerger(shuffle=False)
+    for chunk in chunks:
+        merger.add(chunk)
+    return merger.result()
+
+
+def _merge_stream(chunks, outfile):
+    merger = ResultMerger(outfile, shuffle=False)
+    for chunk in chunks:
+        merger.add(chunk)
+    return merger.result()
+
+
+def benchmark_merging(nr_rows=200000, nr_features=256, nr_chunks=(4, 16, 64, 256)):
+    """Times merging the same rows split into an increasing number of chunks,
+    once with a concat per chunk and once with each mode of ResultMerger.
+    """
+    dataframe = make_dataframe(nr_rows, nr_features)
+    print(f"Merging {nr_rows} rows with {nr_features} features")
+    print(f"{'chunks':>8}{'concat per chunk':>20}{'collect':>12}{'stream':>12}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        outfile = os.path.join(temp_dir, 'merged.txt')
+        for nr_chunk in nr_chunks:
+            chunks = [dataframe.iloc[rows] for rows in np.array_split(np.arange(nr_rows), nr_chunk)]
+            runtimes = []
+            for merge in (_merge_quadratic, _merge_collect, lambda c: _merge_stream(c, outfile)):
+                start = time.perf_counter()
+                merge(chunks)
+                runtimes.append(time.perf_counter() - start)
+            print(f"{nr_chunk:>8}{runtimes[0]:>19.3f}s{runtimes[1]:>11.3f}s{runtimes[2]:>11.3f}s")
+
+
+def benchmark_p_values(nr_samples=100000, nr_calibration=10000, nr_trees=500, seed=0):
+    """Times the conformal p-values of one class computed per sample with
+    get_CP_p_value, with the vectorized conformal_p_values and looked up in
+    a PValueTable.
+    """
+    rng = np.random.default_rng(seed)
+    # Forest scores take at most nr_trees + 1 distinct values.
+    calibration_alphas_c = np.sort(rng.integers(0, nr_trees + 1, nr_calibration) / nr_trees)
+    nonconf_scores = rng.integers(0, nr_trees + 1, nr_samples) / nr_trees
+    model = ClassifierRF(smooth=True)
+    print(f"P-values of {nr_samples} samples against {nr_calibration} calibration scores")
+
+    start = time.perf_counter()
+    for nonconf_score in nonconf_scores:
+        model.get_CP_p_value(nonconf_score, calibration_alphas_c)
+    runtime_loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    conformal_p_values(nonconf_scores, calibration_alphas_c, smooth=True)
+    runtime_vectorized = time.perf_counter() - start
+
+    table = PValueTable.from_scores(calibration_alphas_c, nr_trees)
+    start = time.perf_counter()
+    table.p_values(nonconf_scores, calibration_alphas_c, smooth=True)
+    runtime_table = time.perf_counter() - start
+    print(f"{'per sample':>12}{'vectorized':>14}{'table':>14}")
+    print(f"{runtime_loop:>11.3f}s{runtime_vectorized:>13.3f}s{runtime_table:>13.3f}s")
+
+
+def benchmark_forest(nr_models=5, nr_trees=100, nr_train=10000, nr_samples=(1000, 10000), nr_features=1024, seed=0):
+    """Times the class probabilities of every member of an ensemble, once
+    with predict_proba per member and once with a FlatForest of all members
+    on bit-packed features.
+    """
+    rng = np.random.default_rng(seed)
+    features = rng.integers(0, 2, (nr_train + max(nr_samples), nr_features), dtype=np.uint8)
+    # A label that depends on a few features, with some noise, so the trees don't grow to pure noise.
+    labels = (features[:, :16].sum(axis=1) > 8) ^ (rng.random(len(features)) < 0.1)
+    models = [ClassifierRF(n_estimators=nr_trees, n_jobs=1).fit(features[i:nr_train:nr_models],
+                                                               labels[i:nr_train:nr_models])
+              for i in range(nr_models)]
+
+    start = time.perf_counter()
+    forest = FlatForest.from_models(models)
+    print(f"Compiled {nr_models} x {nr_trees} trees with {len(forest.feature)} nodes in "
+          f"{time.perf_counter() - start:.3f}s")
+    print(f"{'samples':>8}{'predict_proba':>16}{'flat forest':>14}{'max difference':>17}")
+    for nr_sample in nr_samples:
+        data = features[nr_train:nr_train + nr_sample]
+        start = time.perf_counter()
+        expected = np.stack([model.predict_proba(data) for model in models], axis=1)
+        runtime_models = time.perf_counter() - start
+
+        start = time.perf_counter()
+        probabilities = forest.predict_proba(np.packbits(data, axis=1), packed=True)
+        runtime_forest = time.perf_counter() - start
+        print(f"{nr_sample:>8}{runtime_models:>15.3f}s{runtime_forest:>13.3f}s"
+              f"{np.abs(probabilities - expected).max():>17.2g}")
+
+
+def benchmark_input_layer(dim_in=1024, dim_out=1000, batch_size=256, densities=(0.02, 0.05, 0.1), nr_batches=50,
+                          seed=0):
+    """Times the forward and backward pass of the first layer of
+    ClassifierNN on random fingerprints, once as nn.Linear on float32
+    features and once as a BitEmbedding with the same weights on the
+    indices of their set bits.
+    """
+    import torch
+    from torch import nn
+
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+    linear = nn.Linear(dim_in, dim_out)
+    embedding = BitEmbedding(dim_in, dim_out)
+    with torch.no_grad():
+        embedding.embedding.weight[:dim_in] = linear.weight.t()
+        embedding.bias[:] = linear.bias
+
+    print(f"{'density':>8}{'linear':>10}{'bit embedding':>16}{'max difference':>17}")
+    for density in densities:
+        features = (rng.random((batch_size, dim_in)) < density).astype(np.uint8)
+        dense = torch.from_numpy(features.astype(np.float32))
+        indices = torch.from_numpy(bit_indices(features))
+
+        runtimes = []
+        for layer, x in ((linear, dense), (embedding, indices)):
+            start = time.perf_counter()
+            for _ in range(nr_batches):
+                layer.zero_grad()
+                layer(x).sum().backward()
+            runtimes.append(time.perf_counter() - start)
+        difference = (linear(dense) - embedding(indices)).abs().max().item()
+        print(f"{density:>8}{runtimes[0]:>9.3f}s{runtimes[1]:>15.3f}s{difference:>17.2g}")
+
+
+BENCHMARKS = {'merging': benchmark_merging, 'p_values': benchmark_p_values, 'forest': benchmark_forest,
+              'input_layer': benchmark_input_layer}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m aichemy.benchmarks')
+    parser.add_argument('benchmark', choices=BENCHMARKS.keys())
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark]()
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import shutil
+
+from aichemy.utils import convert_dataset, is_binary_dataset, BINARY_DATASET_EXTENSION, BINARY_DATASET_META
+
+CACHE_KEYS = ['stat', 'content']
+HASH_BLOCK_SIZE = 2 ** 24
+
+
+class DatasetCache(object):
+    """Keeps binary copies of text datasets, so repeated runs on the same
+    file read a memory-mapped dataset instead of parsing the text again.
+
+    Entries are keyed by the absolute path, size and modification time of the
+    input file, or by a hash of its content. The cache is bounded by
+    max_size (in GB) and evicts the least recently used entries first.
+    """
+    def __init__(self, cache_dir, max_size, key_type='stat'):
+        if key_type not in CACHE_KEYS:
+            error_message = f"Unsupported cache key: {key_type}"
+            raise ValueError(error_message)
+
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size * 2 ** 30)
+        self.key_type = key_type
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, infile):
+        digest = hashlib.sha1()
+        if self.key_type == 'content':
+            with open(infile, 'rb') as fin:
+                for block in iter(lambda: fin.read(HASH_BLOCK_SIZE), b''):
+                    digest.update(block)
+        else:
+            stat = os.stat(infile)
+            digest.update(f"{os.path.abspath(infile)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    def get(self, infile):
+        """Returns the cached binary dataset of infile, or None on a miss."""
+        entry = self._entry_path(self.key(infile))
+        if is_binary_dataset(entry):
+            # The modification time of the meta file is the LRU timestamp.
+            os.utime(os.path.join(entry, BINARY_DATASET_META))
+            return entry
+        return None
+
+    def put(self, infile):
+        """Converts infile into the cache and returns the cached dataset, or
+        None if the file can't be stored in the binary format.
+        """
+        entry = self._entry_path(self.key(infile))
+        temp_entry = f"{entry}.tmp-{os.getpid()}"
+        try:
+            convert_dataset(infile, temp_entry)
+        except ValueError as e:
+            print(f"Couldn't cache {infile}: {e}")
+            shutil.rmtree(temp_entry, ignore_errors=True)
+            return None
+
+        try:
+            os.rename(temp_entry, entry)
+        except OSError:
+            # Another process cached the same file in the meantime.
+            shutil.rmtree(temp_entry, ignore_errors=True)
+
+        self.evict(keep=entry)
+        return entry
+
+    def fetch(self, infile):
+        entry = self.get(infile)
+        if entry is not None:
+            print(f"\nUsing cached dataset for {infile}")
+            return entry
+        return self.put(infile)
+
+    def evict(self, keep=None):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, file_name)
+            if file_name.endswith(BINARY_DATASET_EXTENSION) and is_binary_dataset(entry):
+                last_used = os.path.getmtime(os.path.join(entry, BINARY_DATASET_META))
+                entries.append((last_used, _get_dir_size(entry), entry))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            print(f"Evicting {entry} from the dataset cache")
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}{BINARY_DATASET_EXTENSION}")
+
+
+def _get_dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
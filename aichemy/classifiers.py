@@ -5,9 +5,13 @@ from copy import copy
 import numpy as np
 from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
+import torch
+from torch import nn
 from torch.nn import Module as NNModule
+from torch.utils.data import Dataset as TorchDataset
 
 CLASSIFIER_TYPES = ['rndfor', 'nn']
+TABLE_TOLERANCE = 1e-9
 
 class AIchemyClassifier(object):
     def __init__(self, classifier_type, config):
@@ -18,13 +22,14 @@ class AIchemyClassifier(object):
     @staticmethod
     def init_classifier(classifier_type, config):
         if classifier_type == 'rndfor':
-            architecture = ClassifierRF(smooth=config.smooth)
+            architecture = ClassifierRF(smooth=config.smooth, n_estimators=config.nr_trees, n_jobs=config.n_jobs)
 
         elif classifier_type == 'nn':
             architecture = ClassifierNN(dim_in=config.dim_in,
                                         dim_hidden=config.dim_hidden,
                                         dim_out=config.dim_out,
-                                        dropout=config.dropout)
+                                        dropout=config.dropout,
+                                        sparse_input=config.sparse_input)
 
         else:
             raise ValueError("Invalid classifier type")
@@ -41,14 +46,16 @@ class AIchemyClassifier(object):
         return copy(self.architecture)
 
     def reset(self):
-        self.architecture.reset()
+        self.architecture = self.architecture.reset()
         return self.architecture
 
 
 class ClassifierRF(RandomForestClassifier):
-    """Inherits from RandomForestClassifier"""
-    def __init__(self, smooth=True):
-        super(ClassifierRF, self).__init__()
+    """Inherits from RandomForestClassifier. Fits and predicts on dense
+    arrays as well as scipy.sparse CSR matrices.
+    """
+    def __init__(self, smooth=True, n_estimators=100, n_jobs=None):
+        super(ClassifierRF, self).__init__(n_estimators=n_estimators, n_jobs=n_jobs)
         global bisect_right
         global bisect_left
         _temp = __import__('bisect', globals(), locals(), ['bisect_right', 'bisect_left'])
@@ -59,23 +66,21 @@ class ClassifierRF(RandomForestClassifier):
     def nonconformity_scores(self, data):
         """Here you define the nonconformity function for your classifier.
         """
-        nonconformity_scores = (lambda x: 1 - x)(self.predict_proba(data).app)
+        nonconformity_scores = (lambda x: 1 - x)(self.predict_proba(data))
 
         return nonconformity_scores
 
-    def cali_nonconf_scores(self, calibration_data):
+    def cali_nonconf_scores(self, calibration_data, calibration_labels):
         """Determine the conformity scores of the calibration data.
         Get prediction probabilities for all classes and store them if
         they belong to the true class, in separate vectors.
         """
-        calibration_alphas = self.nonconformity_scores(calibration_data.values[:, 1:])
+        calibration_alphas = self.nonconformity_scores(calibration_data)
         # Get number of classes
-        nr_class = len(calibration_alphas[0])
+        nr_class = calibration_alphas.shape[1]
         # Iterate over all classes and retrieve calibration scores
         for c in range(nr_class):
-            calibration_alpha_c = np.array([calibration_alphas[i][c]
-                                            for i in range(len(calibration_alphas))
-                                            if calibration_data.values[i, 0] == c])
+            calibration_alpha_c = calibration_alphas[calibration_labels == c, c]
 
             # Sorting arrays in-place without a copy (lowest to highest).
             calibration_alpha_c.sort()
@@ -104,29 +109,49 @@ class ClassifierRF(RandomForestClassifier):
             p_c = (n_over + (n_equal * random.random())) / (float(size_cal_list + 1))
         return p_c
 
+    def get_CP_p_values(self, nonconf_scores, calibration_alphas, tables=None):
+        """Returns the p-values of a block of samples, the vectorized
+        get_CP_p_value. nonconf_scores holds a column per class and
+        calibration_alphas the sorted calibration scores of each class.
+        With the PValueTable of each class the p-values are looked up.
+        """
+        p_values = np.empty(nonconf_scores.shape, dtype=float)
+        for c, calibration_alphas_c in enumerate(calibration_alphas):
+            if tables is None:
+                p_values[:, c] = conformal_p_values(nonconf_scores[:, c], calibration_alphas_c, smooth=self.smooth)
+            else:
+                p_values[:, c] = tables[c].p_values(nonconf_scores[:, c], calibration_alphas_c, smooth=self.smooth)
+        return p_values
+
+    def get_p_value_tables(self, calibration_alphas):
+        """Returns a PValueTable per class for the sorted calibration scores."""
+        return [PValueTable.from_scores(calibration_alphas_c, len(self.estimators_))
+                for calibration_alphas_c in calibration_alphas]
+
     def reset(self):
-        clone(self)
+        return clone(self)
 
 
 class ClassifierNN(NNModule, ABC):
-    def __init__(self, dim_in: int, dim_hidden: list, dim_out: int, dropout: float):
+    """A fully connected net. With sparse_input the first layer is a
+    BitEmbedding, which sums the weights of the set bits of a fingerprint
+    instead of multiplying all of its zeros. Both first layers take dense
+    float features as well as the padded bit indices of bit_indices.
+    """
+    def __init__(self, dim_in: int, dim_hidden: list, dim_out: int, dropout: float, sparse_input: bool = False):
         super(ClassifierNN, self).__init__()
-        global nn
-        _temp = __import__('torch', globals(), locals(), ['nn'])
-        nn = _temp.nn
         self.layer_depth = len(dim_hidden) + 1
         dim_hidden.insert(0, dim_in)
         dim_hidden.append(dim_out)
         self.layer_dimensions = dim_hidden
         self.layer_dropout_proc = dropout
-
-        fc = nn.ModuleList([])
-        for i in range(self.layer_depth):
-            fc.append(nn.Linear(self.layer_dimensions[i], self.layer_dimensions[i + 1]))
-        self.fc = fc
-        self.dropout = nn.Dropout(p=self.layer_dropout_proc)
+        self.sparse_input = sparse_input
+        self.reset()
 
     def forward(self, x):
+        if not x.is_floating_point() and isinstance(self.fc[0], nn.Linear):
+            # Bit indices for a dense first layer, the padding index is cut off again.
+            x = x.new_zeros((len(x), self.layer_dimensions[0] + 1), dtype=torch.float32).scatter_(1, x, 1)[:, :-1]
         for i in range(self.layer_depth - 1):
             x = self.dropout(nn.functional.relu(self.fc[i](x)))
         x = self.fc[self.layer_depth - 1](x)
@@ -135,7 +160,227 @@ class ClassifierNN(NNModule, ABC):
     def reset(self):
         fc = nn.ModuleList([])
         for i in range(self.layer_depth):
-            fc.append(nn.Linear(self.layer_dimensions[i], self.layer_dimensions[i + 1]))
+            if i == 0 and getattr(self, 'sparse_input', False):
+                fc.append(BitEmbedding(self.layer_dimensions[i], self.layer_dimensions[i + 1]))
+            else:
+                fc.append(nn.Linear(self.layer_dimensions[i], self.layer_dimensions[i + 1]))
         self.fc = fc
         self.dropout = nn.Dropout(p=self.layer_dropout_proc)
         return self
+
+
+class BitEmbedding(NNModule):
+    """A linear layer on 0/1 features given as the indices of their set bits.
+
+    The indices of a batch are a samples x bits matrix padded with dim_in,
+    as made by bit_indices. Every row is summed by an EmbeddingBag over the
+    rows of the weight, the padding row is left out. Dense float features
+    are multiplied with the weight as by nn.Linear. The weight and bias are
+    initialized as those of nn.Linear(dim_in, dim_out).
+    """
+    def __init__(self, dim_in, dim_out):
+        super(BitEmbedding, self).__init__()
+        self.dim_in = dim_in
+        self.embedding = nn.EmbeddingBag(dim_in + 1, dim_out, mode='sum', padding_idx=dim_in)
+        self.bias = nn.Parameter(torch.empty(dim_out))
+        bound = 1 / np.sqrt(dim_in)
+        with torch.no_grad():
+            nn.init.uniform_(self.embedding.weight, -bound, bound)
+            self.embedding.weight[dim_in].zero_()
+            nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        if x.is_floating_point():
+            return x @ self.embedding.weight[:self.dim_in] + self.bias
+        return self.embedding(x) + self.bias
+
+
+def bit_indices(features, nr_features=None):
+    """Returns the indices of the set bits of every row of 0/1 features, or
+    of features bit-packed with np.packbits when nr_features is given, as a
+    samples x bits int64 matrix. Rows with fewer bits are padded with the
+    number of features.
+    """
+    if nr_features is None:
+        nr_features = features.shape[1]
+    else:
+        features = np.unpackbits(features, axis=1, count=nr_features)
+    rows, columns = np.nonzero(features)
+    counts = np.bincount(rows, minlength=len(features))
+    indices = np.full((len(features), max(int(counts.max(initial=0)), 1)), nr_features, dtype=np.int64)
+    # The position of every bit within its row, the bits of a row follow each other in np.nonzero.
+    positions = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    indices[rows, positions] = columns
+    return indices
+
+
+class FingerprintDataset(TorchDataset):
+    """The rows of a fingerprint matrix selected by an index array, for
+    training ClassifierNN without a float32 copy of the features.
+
+    The features stay uint8 0/1 values, or bit-packed when nr_features is
+    given, and subsets share them. A batch of rows is gathered by
+    __getitems__ and only unpacked and cast to float32 in
+    collate_fingerprints, which the DataLoaders of the net have to use.
+    With as_bit_indices the batches are the bit_indices of the rows, for
+    the BitEmbedding of a net with sparse_input.
+    """
+    def __init__(self, features, labels, indices=None, nr_features=None, as_bit_indices=False):
+        self.features = features
+        self.labels = labels
+        self.indices = np.arange(len(labels)) if indices is None else np.asarray(indices)
+        self.nr_features = nr_features
+        self.as_bit_indices = as_bit_indices
+
+    def subset(self, indices):
+        return FingerprintDataset(self.features, self.labels, self.indices[indices], self.nr_features,
+                                  self.as_bit_indices)
+
+    @property
+    def shape(self):
+        return len(self.indices), self.nr_features or self.features.shape[1]
+
+    @property
+    def y(self):
+        return self.labels[self.indices]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        return self.__getitems__([i])
+
+    def __getitems__(self, positions):
+        rows = self.indices[positions]
+        return FingerprintBatch(self.features[rows], self.labels[rows], self.nr_features, self.as_bit_indices)
+
+
+class FingerprintBatch(object):
+    def __init__(self, features, labels, nr_features=None, as_bit_indices=False):
+        self.features = features
+        self.labels = labels
+        self.nr_features = nr_features
+        self.as_bit_indices = as_bit_indices
+
+
+def collate_fingerprints(batch):
+    """Collates a batch of a FingerprintDataset into float32 features, or
+    their bit indices, and int64 labels. Other batches, e.g. of the arrays
+    skorch wraps itself, are collated as usual.
+    """
+    from torch.utils.data import default_collate
+
+    if isinstance(batch, list) and batch and isinstance(batch[0], FingerprintBatch):
+        # Rows fetched one at a time, when the DataLoader doesn't use __getitems__.
+        batch = FingerprintBatch(np.concatenate([item.features for item in batch]),
+                                 np.concatenate([item.labels for item in batch]), batch[0].nr_features,
+                                 batch[0].as_bit_indices)
+    elif not isinstance(batch, FingerprintBatch):
+        return default_collate(batch)
+
+    labels = torch.from_numpy(batch.labels.astype(np.int64))
+    if batch.as_bit_indices:
+        return torch.from_numpy(bit_indices(batch.features, batch.nr_features)), labels
+
+    features = batch.features
+    if batch.nr_features is not None:
+        features = np.unpackbits(features, axis=1, count=batch.nr_features)
+    return torch.from_numpy(features.astype(np.float32)), labels
+
+
+class PValueTable(object):
+    """Counts of the calibration scores over and equal to every score the
+    forest can give.
+
+    A forest of fully grown trees scores a sample with the share of trees
+    that didn't vote for a class, so there are only nr_trees + 1 possible
+    scores k / nr_trees. The counts of each are looked up by k instead of
+    searching the calibration scores per sample. Scores that aren't a
+    multiple of 1 / nr_trees, e.g. from impure leaves, are searched as
+    before. Scores within TABLE_TOLERANCE count as equal, as the summation
+    order of the trees can change the last bits of a score.
+    """
+    def __init__(self, nr_trees, n_over, n_equal, size_cal_list):
+        self.nr_trees = nr_trees
+        self.n_over = n_over
+        self.n_equal = n_equal
+        self.size_cal_list = size_cal_list
+
+    @classmethod
+    def from_scores(cls, calibration_alphas_c, nr_trees):
+        grid = np.arange(nr_trees + 1) / nr_trees
+        left_index = np.searchsorted(calibration_alphas_c, grid - TABLE_TOLERANCE, side='left')
+        right_index = np.searchsorted(calibration_alphas_c, grid + TABLE_TOLERANCE, side='right')
+        size_cal_list = len(calibration_alphas_c)
+        return cls(nr_trees, size_cal_list - right_index, right_index - left_index, size_cal_list)
+
+    def p_values(self, nonconf_scores, calibration_alphas_c, smooth=True):
+        scaled_scores = nonconf_scores * self.nr_trees
+        k = np.rint(scaled_scores).astype(np.int64)
+        on_grid = (np.abs(scaled_scores - k) < TABLE_TOLERANCE * self.nr_trees) & (k >= 0) & (k <= self.nr_trees)
+        k[~on_grid] = 0
+
+        n_over = self.n_over[k]
+        n_equal = self.n_equal[k]
+        if smooth:
+            p_values = (n_over + n_equal * np.random.random(len(k))) / float(self.size_cal_list + 1)
+        else:
+            p_values = (n_over + n_equal) / float(self.size_cal_list + 1)
+
+        if not on_grid.all():
+            p_values[~on_grid] = conformal_p_values(nonconf_scores[~on_grid], calibration_alphas_c, smooth=smooth)
+        return p_values
+
+    def to_arrays(self, c):
+        """Returns the arrays of the table under the keys of class c, as stored by np.savez."""
+        return {f"n_over_{c}": self.n_over, f"n_equal_{c}": self.n_equal,
+                f"size_{c}": np.array(self.size_cal_list), f"nr_trees_{c}": np.array(self.nr_trees)}
+
+    @classmethod
+    def from_arrays(cls, arrays, c):
+        return cls(int(arrays[f"nr_trees_{c}"]), arrays[f"n_over_{c}"], arrays[f"n_equal_{c}"],
+                   int(arrays[f"size_{c}"]))
+
+
+def conformal_p_values(nonconf_scores, calibration_alphas_c, smooth=True):
+    """Returns the p-values of an array of nonconformity scores against the
+    sorted calibration scores of one class, like get_CP_p_value does for a
+    single score.
+    """
+    size_cal_list = len(calibration_alphas_c)
+    index_p_c = np.searchsorted(calibration_alphas_c, nonconf_scores, side='left')
+    n_equal_or_over = size_cal_list - index_p_c
+    if not smooth:
+        return n_equal_or_over / float(size_cal_list + 1)
+
+    right_index = np.searchsorted(calibration_alphas_c, nonconf_scores, side='right')
+    n_equal = right_index - index_p_c
+    n_over = n_equal_or_over - n_equal
+    return (n_over + n_equal * np.random.random(len(n_equal))) / float(size_cal_list + 1)
+
+
+def margin_nonconformity(probabilities):
+    """Returns the margin nonconformity score of every sample for every
+    class, 0.5 - (p_c - max of the other p) / 2, as MarginErrFunc of
+    nonconformist gives it for one class.
+    """
+    order = np.argsort(probabilities, axis=1)
+    highest = np.take_along_axis(probabilities, order[:, -1:], axis=1)
+    second = np.take_along_axis(probabilities, order[:, -2:-1], axis=1)
+    max_other = np.where(np.arange(probabilities.shape[1]) == order[:, -1:], second, highest)
+    return 0.5 - (probabilities - max_other) / 2
+
+
+def icp_p_values(nonconf_scores, calibration_scores, smoothing=True):
+    """Returns the p-values of an array of nonconformity scores against the
+    ascending calibration scores of an ICP, as IcpClassifier of
+    nonconformist computes them one sample at a time.
+    """
+    size_cal_list = len(calibration_scores)
+    left_index = np.searchsorted(calibration_scores, nonconf_scores, side='left')
+    right_index = np.searchsorted(calibration_scores, nonconf_scores, side='right')
+    n_over = size_cal_list - right_index
+    n_equal = right_index - left_index
+    if smoothing:
+        return (n_over + (n_equal + 1) * np.random.random(nonconf_scores.shape)) / float(size_cal_list + 1)
+    return (n_over + n_equal + 1) / float(size_cal_list + 1)
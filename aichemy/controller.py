@@ -4,7 +4,7 @@ import os
 from datetime import datetime
 
 from aichemy.classifiers import CLASSIFIER_TYPES
-from aichemy.utils import ModeError
+from aichemy.utils import ModeError, is_binary_dataset, BINARY_DATASET_EXTENSION, COMPRESSED_EXTENSIONS
 
 MODEL_MODES = ['build', 'improve', 'predict', 'validate']
 DATA_MODES = ['postproc', 'preproc']
@@ -13,7 +13,8 @@ SUBMODES = ['preproc_mode', 'postproc_mode']
 ALL_MODES = MODEL_MODES + DATA_MODES + AUTO_MODES + SUBMODES
 
 OCCASIONAL_FLAGS = ['outfile', 'outfile2', 'classifier', 'models_dir', 'percentage', 'shuffle', 'error_bars', 'significance',
-                    'name', 'override_config', 'chunksize', 'nr_cores']
+                    'name', 'override_config', 'chunksize', 'nr_cores', 'no_cache',
+                    'sparse', 'memory_budget']
 ALL_FLAGS = ['infile', 'name', 'override_config'] + OCCASIONAL_FLAGS
 
 PYTORCH_OPTIMIZERS = ['Adam', 'AdamW', 'Adamax', 'RMSprop', 'SGD', 'Adagrad', 'Adadelta']
@@ -83,6 +84,14 @@ class AIchemyPref(object):
         parser_preproc_trim = parser_preproc_mode.add_parser('trim',
                                                              help="Trims a datasets and saves it")
 
+        parser_preproc_shuffle = parser_preproc_mode.add_parser('shuffle',
+                                                                help="Shuffles the rows of a dataset, also when it's "
+                                                                     "bigger than the memory")
+
+        parser_preproc_convert = parser_preproc_mode.add_parser('convert',
+                                                                help="Converts a dataset to the memory-mapped binary "
+                                                                     "format that all modes can read directly")
+
         parser_postproc = parser_command.add_parser('postproc',
                                                     help="Preforms various post-precessing operations")
 
@@ -100,8 +109,8 @@ class AIchemyPref(object):
 
         all_parsers = [parser_auto, parser_build, parser_improve, parser_predict, parser_validate,
                        parser_preproc_balancing, parser_preproc_sample, parser_preproc_split,
-                       parser_preproc_trim, parser_postproc_summary, parser_postproc_plot,
-                       parser_postproc_structure_check]
+                       parser_preproc_trim, parser_preproc_shuffle, parser_preproc_convert, parser_postproc_summary,
+                       parser_postproc_plot, parser_postproc_structure_check]
 
         for subparser in [parser_auto, parser_build, parser_improve, parser_predict, parser_validate,
                           parser_postproc_structure_check]:
@@ -118,7 +127,8 @@ class AIchemyPref(object):
                                         "be combine with multiple infiles to add data to one plot")
 
         for subparser in [parser_predict, parser_validate, parser_preproc_balancing, parser_preproc_sample,
-                          parser_preproc_split, parser_preproc_trim, parser_postproc_summary, parser_postproc_plot]:
+                          parser_preproc_split, parser_preproc_trim, parser_preproc_shuffle, parser_preproc_convert,
+                          parser_postproc_summary, parser_postproc_plot]:
             subparser.add_argument('-o', '--outfile',
                                    default=None,
                                    help="Specify the output file with path. If it's not specified for \'predict\' "
@@ -157,6 +167,13 @@ class AIchemyPref(object):
                                    action='store_true',
                                    help="Specify that the data should be shuffled")
 
+        for subparser in [parser_preproc_balancing, parser_preproc_sample, parser_preproc_split,
+                          parser_preproc_trim]:
+            subparser.add_argument('-sp', '--sparse',
+                                   default=False,
+                                   action='store_true',
+                                   help="Specify that the features should be kept in a sparse matrix")
+
         for subparser in [parser_postproc_plot]:
             subparser.add_argument('-eb', '--error_bars',
                                    default=False,
@@ -177,29 +194,40 @@ class AIchemyPref(object):
                                    default=None,
                                    help="Specify a parameter in the configuration that will to be override ")
 
-        for subparser in [parser_auto, parser_preproc_balancing, parser_preproc_sample]:
+        for subparser in [parser_auto, parser_preproc_balancing, parser_preproc_sample, parser_preproc_split,
+                          parser_preproc_trim, parser_preproc_convert]:
             subparser.add_argument('-ch', '--chunksize',
                                    default=None,
                                    type=int,
                                    help="Specify the size of chunks the files should be divided into.")
 
-        for subparser in [parser_auto, parser_preproc_balancing, parser_preproc_sample, parser_preproc_split,
-                          parser_preproc_trim]:
+        for subparser in [parser_auto, parser_build, parser_improve, parser_predict, parser_validate,
+                          parser_preproc_balancing, parser_preproc_sample, parser_preproc_split, parser_preproc_trim]:
             subparser.add_argument('-nc', '--nr_cores',
                                    default=1,
                                    type=int,
                                    help="Specify the amount of cores should be used.")
 
-        args = parser.parse_args()
+        for subparser in [parser_auto, parser_build, parser_improve, parser_predict, parser_validate,
+                          parser_preproc_balancing, parser_preproc_sample, parser_preproc_split, parser_preproc_trim]:
+            subparser.add_argument('--no_cache', '--no-cache',
+                                   dest='no_cache',
+                                   default=False,
+                                   action='store_true',
+                                   help="Specify that input files shouldn't be read from or stored in the dataset "
+                                        "cache")
 
-        if hasattr(args, 'preproc_mode'):
-            if (args.preproc_mode == 'balancing' or args.preproc_mode == 'sample')\
-                    and (args.nr_cores and not args.chunksize):
-                parser.error("Multicore has to be executed with chunking in preproc mode.")
+        for subparser in [parser_auto, parser_build, parser_improve, parser_predict, parser_validate,
+                          parser_preproc_balancing, parser_preproc_sample, parser_preproc_split, parser_preproc_trim,
+                          parser_preproc_shuffle]:
+            subparser.add_argument('-mb', '--memory_budget',
+                                   default=None,
+                                   type=float,
+                                   help="Specify the memory (in GB) the run may use. Chunk, batch and worker counts "
+                                        "are chosen to fit in it and bigger datasets are shuffled on disk. Defaults "
+                                        "to half of the available memory.")
 
-            if (args.preproc_mode == 'split' or args.preproc_mode == 'trim') \
-                    and (args.nr_cores or args.chunksize):
-                parser.error(f"Preproc {args.preproc_mode} be can't executed in multicore submode or with chunking.")
+        args = parser.parse_args()
 
         return args
 
@@ -268,10 +296,12 @@ class ConfigClf(object):
             self.prop_train_ratio = float(config['random_forest']['prop_train_ratio'])
             self.nr_trees = int(config['random_forest']['nr_of_trees'])
             self.n_jobs = int(config['random_forest']['n_jobs'])
-            self.pred_nrow = float(config['random_forest']['pred_nrow']),
-            self.val_folds = int(config['random_forest']['val_folds']),
-            self.smooth = boolean(config['random_forest']['smooth']),
+            self.parallel_models = int(config['random_forest']['parallel_models'])
+            self.pred_nrow = int(config['random_forest']['pred_nrow'])
+            self.val_folds = int(config['random_forest']['val_folds'])
+            self.smooth = boolean(config['random_forest']['smooth'])
             self.data_type = str(config['random_forest']['data_type'])
+            self.sparse = boolean(config['random_forest']['sparse'])
 
         if classifier_type == 'nn' or classifier_type == 'all':
             self.val_ratio = float(config['neural_network']['val_ratio'])
@@ -280,7 +310,9 @@ class ConfigClf(object):
             self.dim_hidden = config_to_list(config['neural_network']['dim_hidden'])
             self.dim_out = int(config['neural_network']['dim_out'])
             self.dropout = float(config['neural_network']['dropout'])
+            self.sparse_input = boolean(config['neural_network']['sparse_input'])
             self.batch_size = int(config['neural_network']['batch_size'])
+            self.parallel_nets = int(config['neural_network']['parallel_nets'])
             self.max_epochs = int(config['neural_network']['max_epochs'])
             self.early_stop_patience = int(config['neural_network']['early_stop_patience'])
             self.early_stop_threshold = float(config['neural_network']['early_stop_threshold'])
@@ -306,6 +338,11 @@ class ConfigExec(object):
             self.auto_plus_sum = boolean(config['auto']['auto_plus_sum'])
             self.auto_plus_plot = boolean(config['auto']['auto_plus_plot'])
             self.train_test_ratio = float(config['auto']['train_test_ratio'])
+            self.streaming_split_size = float(config['auto']['streaming_split_size'])
+
+        self.cache_dir = config['cache']['cache_dir']
+        self.cache_max_size = float(config['cache']['cache_max_size'])
+        self.cache_key = config['cache']['cache_key']
 
         if operator_mode == 'postproc' or operator_mode == 'auto':
             self.error_level = int(config['postproc']['error_level'])
@@ -314,6 +351,7 @@ class ConfigExec(object):
         if operator_mode == 'preproc' or operator_mode == 'auto':
             self.sample_ratio = float(config['preproc']['sample_ratio'])
             self.balancing_ratio = float(config['preproc']['balancing_ratio'])
+            self.split_seed = int(config['preproc']['split_seed'])
 
 
 class AIchemyController(AIchemyPref):
@@ -326,6 +364,9 @@ class AIchemyController(AIchemyPref):
     predictions_dir = None
     args = None
     config = None
+    cache = None
+    planner = None
+    auto_data = None
     session = None
 
     def __new__(cls, *args, **kwargs):
@@ -354,6 +395,10 @@ class AIchemyController(AIchemyPref):
         if self.args.mode == 'preproc' or self.args.mode == 'postproc' or self.args.mode == 'auto':
             self.update_outfile()
 
+        if self.args.mode in self.model_modes or self.args.mode in self.auto_modes or self.args.mode == 'preproc':
+            self.add_cache()
+            self.add_planner()
+
     def update_infiles(self):
         nr_infiles = len(self.args.infiles)
         if nr_infiles == 1:
@@ -364,7 +409,7 @@ class AIchemyController(AIchemyPref):
                 else:
                     infile = f"{self.src_dir}/data/{infile}"
 
-            if os.path.isfile(infile):
+            if os.path.isfile(infile) or is_binary_dataset(infile):
                 self.args.infile = infile
             else:
                 raise FileNotFoundError(f"Couldn't find the input file, both absolut path and file name in the "
@@ -411,6 +456,16 @@ class AIchemyController(AIchemyPref):
                     elif self.args.preproc_mode == 'sample':
                         self.args.outfile = f"{self.project_dir}/{infile_name}_sampled{infile_extension}"
 
+                    elif self.args.preproc_mode == 'shuffle':
+                        if self.args.outfile is None:
+                            if infile_extension in COMPRESSED_EXTENSIONS:
+                                infile_name, infile_extension = os.path.splitext(infile_name)
+                            self.args.outfile = f"{self.project_dir}/{infile_name}_shuffled{infile_extension}"
+
+                    elif self.args.preproc_mode == 'convert':
+                        if self.args.outfile is None:
+                            self.args.outfile = f"{self.project_dir}/{infile_name}{BINARY_DATASET_EXTENSION}"
+
                     elif self.args.preproc_mode == 'split':
                         if self.args.outfile is None:
                             self.args.outfile = f"{self.project_dir}/{infile_name}_train{infile_extension}"
@@ -490,6 +545,23 @@ class AIchemyController(AIchemyPref):
                 except (KeyError, FileExistsError) as e:
                     pass
 
+    def add_cache(self):
+        if self.args.no_cache:
+            self.cache = None
+            return
+
+        from aichemy.cache import DatasetCache
+
+        cache_dir = self.config.execute.cache_dir
+        if not cache_dir:
+            cache_dir = f"{self.src_dir}/data/.cache"
+        self.cache = DatasetCache(cache_dir, self.config.execute.cache_max_size, self.config.execute.cache_key)
+
+    def add_planner(self):
+        from aichemy.planner import ExecutionPlanner
+
+        self.planner = ExecutionPlanner(self.args.memory_budget)
+
     @classmethod
     def get(cls, key):
         return getattr(cls, key)
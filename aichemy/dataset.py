@@ -0,0 +1,200 @@
+import numpy as np
+import pandas as pd
+
+from aichemy.utils import read_fingerprints, fingerprints_to_dataframe, compact_ids, decode_ids, is_binary_dataset, \
+    BinaryDataset, ResultMerger, BINARY_DATASET_CHUNKSIZE
+
+
+class AIchemyDataset(object):
+    """Samples stored once as compact ids, int8 classes and uint8 features.
+
+    The preprocessing operations (balance, sample, split, trim and shuffle)
+    don't copy any rows. They return views of the same arrays that select
+    their rows with an index array. Rows are only gathered into contiguous
+    memory when a consumer asks for them, e.g. through to_arrays or
+    to_dataframe. The features of binary datasets stay memory-mapped and
+    bit-packed until then.
+    """
+    def __init__(self, ids, labels, features, indices=None, nr_features=None):
+        self._ids = ids
+        self._labels = labels
+        self._features = features
+        self.indices = indices
+        self.packed = nr_features is not None
+        if self.packed:
+            self.nr_features = nr_features
+        else:
+            self.nr_features = features.shape[1]
+
+    @classmethod
+    def from_file(cls, infile, nr_cores=1, cache=None, pool=None, packed=False):
+        """Reads a dataset, mapping binary datasets. With packed the features
+        of text files are bit-packed while they are read, as those of binary
+        datasets are.
+        """
+        if cache is not None and not is_binary_dataset(infile):
+            infile = cache.fetch(infile) or infile
+
+        if is_binary_dataset(infile):
+            print(f"\nMapping binary dataset {infile}")
+            dataset = BinaryDataset(infile)
+            return cls(dataset.ids, dataset.labels, dataset.features, nr_features=dataset.nr_features)
+        if packed:
+            ids, labels, features, nr_features = read_fingerprints(infile, nr_cores=nr_cores, pool=pool, packed=True)
+            return cls(ids, labels, features, nr_features=nr_features)
+        return cls(*read_fingerprints(infile, nr_cores=nr_cores, pool=pool))
+
+    @classmethod
+    def from_dataframe(cls, dataframe):
+        return cls(compact_ids(dataframe['id']),
+                   dataframe['class'].to_numpy(dtype=np.int8),
+                   dataframe.iloc[:, 2:].to_numpy(dtype=np.uint8))
+
+    def __len__(self):
+        if self.indices is None:
+            return len(self._labels)
+        return len(self.indices)
+
+    def view(self, indices):
+        """Returns a dataset of the given rows of this one, sharing its arrays."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return AIchemyDataset(self._ids, self._labels, self._features, indices,
+                              self.nr_features if self.packed else None)
+
+    @property
+    def ids(self):
+        return self._take(self._ids)
+
+    @property
+    def labels(self):
+        return self._take(self._labels)
+
+    def get_features(self, start=0, stop=None):
+        """Gathers the features of the rows in [start, stop) as a contiguous 0/1 uint8 matrix."""
+        features = self._take(self._features, start, stop)
+        if self.packed:
+            features = np.unpackbits(features, axis=1, count=self.nr_features)
+        return features
+
+    def get_packed_features(self, start=0, stop=None):
+        """Gathers the features of the rows in [start, stop) bit-packed with np.packbits."""
+        features = self._take(self._features, start, stop)
+        if not self.packed:
+            features = np.packbits(features, axis=1)
+        return features
+
+    def _take(self, array, start=0, stop=None):
+        if self.indices is None:
+            return np.asarray(array[start:stop])
+        return np.asarray(array[self.indices[start:stop]])
+
+    def iter_blocks(self, block_size):
+        """Yields the ids, classes and 0/1 uint8 features of the rows, gathered block_size rows at a time."""
+        for start in range(0, len(self), block_size):
+            stop = start + block_size
+            yield self._take(self._ids, start, stop), self._take(self._labels, start, stop), \
+                self.get_features(start, stop)
+
+    def to_arrays(self):
+        return self.ids, self.labels, self.get_features()
+
+    def to_dataframe(self, start=0, stop=None):
+        return fingerprints_to_dataframe(self._take(self._ids, start, stop),
+                                         self._take(self._labels, start, stop),
+                                         self.get_features(start, stop))
+
+    def save(self, outfile):
+        """Writes the rows to a text file or binary dataset, gathering one block of rows at a time."""
+        merger = ResultMerger(outfile, shuffle=False)
+        for start in range(0, len(self), BINARY_DATASET_CHUNKSIZE):
+            stop = start + BINARY_DATASET_CHUNKSIZE
+            merger.add_fingerprints(self._take(self._ids, start, stop),
+                                    self._take(self._labels, start, stop),
+                                    self._take(self._features, start, stop),
+                                    packed=self.packed, nr_features=self.nr_features)
+        return merger.result()
+
+    def balance(self, percentage=1):
+        indices = balancing_indices(self.labels, percentage=percentage)
+        return self.view(np.random.permutation(indices))
+
+    def sample(self, percentage=1):
+        return self.view(sample_indices(len(self), percentage=percentage))
+
+    def shuffle(self):
+        return self.view(np.random.permutation(len(self)))
+
+    def split(self, percentage, shuffle=False):
+        if shuffle:
+            order = np.random.permutation(len(self))
+        else:
+            order = np.arange(len(self))
+        indices_large, indices_small = split_indices(order, percentage)
+        return self.view(indices_large), self.view(indices_small)
+
+    def trim(self, percentage, shuffle=False):
+        return self.split(percentage, shuffle=shuffle)[0]
+
+
+def balancing_indices(labels, percentage=1):
+    """Returns the row indices kept by balancing: every row of the smallest
+    class and round(percentage * size of the smallest class) randomly chosen
+    rows of each other class.
+    """
+    labels = np.asarray(labels)
+    classes, counts = np.unique(labels, return_counts=True)
+    # On ties the highest class is kept whole, which for 0/1 data is the active class 1.
+    minority = classes[len(classes) - 1 - np.argmin(counts[::-1])] if len(classes) else None
+    nr_samples = int(np.round(counts.min() * percentage, decimals=0)) if len(classes) > 1 else 0
+
+    if nr_samples > 1:
+        indices = [np.flatnonzero(labels == minority)]
+        for label, count in zip(classes, counts):
+            if label != minority:
+                indices.append(np.random.choice(np.flatnonzero(labels == label), min(nr_samples, count),
+                                                replace=False))
+        return np.concatenate(indices)
+    else:
+        return np.empty(0, dtype=np.int64)
+
+
+def balancing_mask(labels, percentage=1):
+    """Returns balancing_indices as a boolean mask over all rows."""
+    mask = np.zeros(len(labels), dtype=bool)
+    mask[balancing_indices(labels, percentage=percentage)] = True
+    return mask
+
+
+def sample_indices(nr_rows, percentage=1):
+    """Returns the row indices sample_dataframe would keep."""
+    return np.random.choice(nr_rows, int(np.round(nr_rows * percentage)), replace=False)
+
+
+def split_indices(indices, percentage):
+    """Splits an index array like split_dataframe splits rows."""
+    index = int(np.round(len(indices) * percentage))
+    return indices[:index], indices[index:]
+
+
+def split_mask(ids, percentage, seed=0):
+    """Assigns rows to the first part of a split by a seeded hash of their
+    ids, so the assignment of a row doesn't depend on the other rows or their
+    order.
+    """
+    hashes = pd.util.hash_array(decode_ids(ids).astype(object), hash_key=f"{seed:016d}"[-16:], categorize=False)
+    return hashes / 2.0 ** 64 < percentage
+
+
+def trim_mask(nr_rows, percentage, shuffle=False):
+    """Marks the rows trim_dataframe keeps: the first ones, or randomly chosen
+    ones when shuffling.
+    """
+    nr_keep = int(np.round(nr_rows * percentage))
+    mask = np.zeros(nr_rows, dtype=bool)
+    if shuffle:
+        mask[np.random.choice(nr_rows, nr_keep, replace=False)] = True
+    else:
+        mask[:nr_keep] = True
+    return mask
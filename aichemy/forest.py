@@ -0,0 +1,111 @@
+import numpy as np
+
+
+class FlatForest(object):
+    """The trees of the members of a random forest ensemble compiled into
+    flat node arrays, traversed for a whole batch of samples at once.
+
+    All nodes of all trees and members are stored one after another as
+    structure of arrays, with the children as global node indices. Leaves
+    are their own children, so the traversal only follows the (sample,
+    tree) pairs that haven't reached a leaf yet. The features can be given as
+    0/1 values or bit-packed with np.packbits, the traversal reads the bit
+    of the split feature directly from the packed bytes.
+    """
+    def __init__(self, children, feature, threshold, value, roots, member_starts, classes):
+        self.children = children
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value
+        self.roots = roots
+        self.member_starts = member_starts
+        self.classes = classes
+        # Trees grown on 0/1 features split at thresholds in [0, 1), where going right is the value of the feature.
+        is_split = np.isfinite(threshold)
+        self.binary_splits = bool(np.all((threshold[is_split] >= 0) & (threshold[is_split] < 1)))
+
+    @classmethod
+    def from_models(cls, models):
+        """Compiles fitted forests, e.g. the members of an ensemble."""
+        forests = []
+        for model in models:
+            states = [estimator.tree_.__getstate__() for estimator in model.estimators_]
+            node_counts = np.array([state['node_count'] for state in states], dtype=np.int64)
+            forests.append((np.concatenate([state['nodes'] for state in states]),
+                            np.concatenate([state['values'] for state in states]),
+                            np.stack([np.cumsum(node_counts) - node_counts, node_counts], axis=1)))
+        return cls.from_arrays(forests, models[0].classes_)
+
+    @classmethod
+    def from_arrays(cls, forests, classes):
+        """Compiles forests given as the node arrays of EnsembleArtifact.map_forest."""
+        children, feature, threshold, value, roots, member_starts = [], [], [], [], [], []
+        nr_nodes = 0
+        nr_trees = 0
+        for nodes, values, trees in forests:
+            # The children are indices within their tree, shifted here to indices into the flat arrays.
+            node_offsets = np.repeat(np.asarray(trees[:, 0]), np.asarray(trees[:, 1])) + nr_nodes
+            is_leaf = nodes['left_child'] < 0
+            self_index = np.arange(nr_nodes, nr_nodes + len(nodes))
+            children.append(np.stack([np.where(is_leaf, self_index, nodes['left_child'] + node_offsets),
+                                      np.where(is_leaf, self_index, nodes['right_child'] + node_offsets)], axis=1))
+            feature.append(np.where(is_leaf, 0, nodes['feature']))
+            threshold.append(np.where(is_leaf, np.inf, nodes['threshold']))
+
+            leaf_values = np.asarray(values[:, 0, :], dtype=np.float32)
+            value.append(leaf_values / np.maximum(leaf_values.sum(axis=1, keepdims=True), np.finfo(np.float32).tiny))
+            roots.append(np.asarray(trees[:, 0]) + nr_nodes)
+            member_starts.append(nr_trees)
+            nr_nodes += len(nodes)
+            nr_trees += len(trees)
+
+        index_type = np.int32 if nr_nodes < 2 ** 31 else np.int64
+        return cls(np.concatenate(children).astype(index_type).ravel(),
+                   np.concatenate(feature).astype(np.int32), np.concatenate(threshold),
+                   np.concatenate(value), np.concatenate(roots).astype(index_type),
+                   np.array(member_starts), np.asarray(classes))
+
+    def __len__(self):
+        return len(self.member_starts)
+
+    def apply(self, X, packed=False):
+        """Returns the leaf every sample reaches in every tree, as an array
+        of samples x trees.
+        """
+        nr_samples, nr_trees = len(X), len(self.roots)
+        X = np.ascontiguousarray(X)
+        row_size = X.shape[1]
+        X = X.ravel()
+        leaves = np.tile(self.roots, nr_samples)
+        pairs = np.arange(nr_samples * nr_trees, dtype=self.roots.dtype)
+        row_offsets = pairs // nr_trees * row_size
+        nodes = leaves.copy()
+        while len(pairs):
+            feature = self.feature[nodes]
+            if packed:
+                x = (X[row_offsets + (feature >> 3)] >> (7 - (feature & 7)).astype(np.uint8)) & 1
+            else:
+                x = X[row_offsets + feature]
+            if packed and self.binary_splits:
+                go_right = x
+            else:
+                go_right = x > self.threshold[nodes]
+            # The children of a node are stored next to each other, left first.
+            next_nodes = self.children[2 * nodes + go_right]
+
+            at_leaf = next_nodes == nodes
+            nodes = next_nodes
+            if at_leaf.any():
+                leaves[pairs[at_leaf]] = nodes[at_leaf]
+                walking = ~at_leaf
+                pairs, row_offsets, nodes = pairs[walking], row_offsets[walking], nodes[walking]
+        return leaves.reshape(nr_samples, nr_trees)
+
+    def predict_proba(self, X, packed=False):
+        """Returns the class probabilities of every member, as an array of
+        samples x members x classes.
+        """
+        leaf_values = self.value[self.apply(X, packed=packed)]
+        member_sums = np.add.reduceat(leaf_values, self.member_starts, axis=1)
+        member_sizes = np.diff(np.append(self.member_starts, len(self.roots)))
+        return member_sums / member_sizes[None, :, None]
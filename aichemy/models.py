@@ -1,30 +1,46 @@
+import io
+import json
 import os
 
 import cloudpickle
 import numpy as np
+import pandas as pd
+from scipy.sparse import issparse
 from abc import ABCMeta, abstractmethod
 
-from aichemy.classifiers import AIchemyClassifier
-from aichemy.preprocessing import PreProcAuto, split_dataframe
-from aichemy.utils import read_dataframe, split_array, get_size
+from aichemy.artifact import EnsembleArtifact
+from aichemy.classifiers import AIchemyClassifier, PValueTable, FingerprintDataset, BitEmbedding, collate_fingerprints, \
+    bit_indices, margin_nonconformity, icp_p_values
+from aichemy.dataset import AIchemyDataset
+from aichemy.forest import FlatForest
+from aichemy.utils import read_dataframe, read_sparse, split_array, get_size, compact_ids, decode_ids, share_arrays, \
+    attach_arrays
+
+SCRIPT_META = 'aichemy.json'
 
 
 class AIchemyModel(object, metaclass=ABCMeta):
     def __init__(self, controller, model_type):
         if controller.args.mode == 'auto':
-            self.auto_save_preproc = controller.config.execute.auto_save_preproc
-            preproc = PreProcAuto(controller)
-            self.data = preproc.run()
+            # Preprocessed once by the operator and shared by all models.
+            self.data = controller.auto_data
             self.auto_mode = True
         else:
             self.infile = controller.args.infile
             self.auto_mode = False
 
+        if controller.args.nr_cores:
+            self.nr_cores = controller.args.nr_cores
+        else:
+            self.nr_cores = 1
+        self.cache = controller.cache
+        self.planner = controller.planner
         self.type = model_type
         self.outfile = controller.args.pred_files[model_type]
         self.config = controller.config.classifier
         self.name = controller.args.name
         self.models_dir = controller.args.models_dir
+        self.artifact = EnsembleArtifact.from_name(self.models_dir, self.name, self.type)
         self.classifier = AIchemyClassifier(self.type, self.config)
 
     @abstractmethod
@@ -52,24 +68,42 @@ class AIchemyModel(object, metaclass=ABCMeta):
         if model is None:
             model = self.classifier.architecture
 
-        model_name = f"{self.models_dir}/{self.name}_{self.type}_m{iteration}.z"
-        if os.path.isfile(model_name):
-            os.remove(model_name)
-        with open(model_name, mode='ab') as f:
-            cloudpickle.dump(model, f)
+        self.artifact.save_model(iteration, model)
 
-    def save_scores(self, calibration_data, iteration=0, model=None):
+    def save_scores(self, calibration_data, calibration_labels, iteration=0, model=None):
         if model is None:
             model = self.classifier.architecture
 
-        for c, alpha_c in enumerate(model.cali_nonconf_scores(calibration_data)):
-            model_score = f"{self.models_dir}/{self.name}_{self.type}_calibration-α{c}_m{iteration}.z"
-            if os.path.isfile(model_score):
-                os.remove(model_score)
-            with open(model_score, mode='ab') as f:
-                cloudpickle.dump(alpha_c, f)
+        calibration_alphas = list(model.cali_nonconf_scores(calibration_data, calibration_labels))
+        self.artifact.save_calibration(iteration, calibration_alphas)
+        return calibration_alphas
 
     def load_models(self):
+        if not self.artifact.exists():
+            return self._load_legacy_models()
+
+        print(f"Loading models from {self.artifact.path}")
+        models = self.artifact.load_models()
+        print(f"Loaded {len(models)} models.")
+        return models
+
+    def load_scores(self):
+        if not self.artifact.exists():
+            return self._load_legacy_scores()
+
+        nr_models = len(self.artifact)
+        nr_class = self.artifact.nr_class
+        scores = [list() for _ in range(nr_class)]
+        print(f"Loading scores from {self.artifact.path}")
+        for i in range(nr_models):
+            for c, alpha_c in enumerate(self.artifact.load_calibration(i)):
+                scores[c].append(alpha_c)
+
+        print(f"Loaded {nr_models} x {nr_class} scores.")
+        return scores, nr_class
+
+    def _load_legacy_models(self):
+        """Loads models saved as one cloudpickle file each, before they were stored as an ensemble."""
         dir_files = os.listdir(self.models_dir)
         nr_models = sum([1 for f in dir_files if f.startswith(f"{self.name}_{self.type}_m")])
         models = []
@@ -82,7 +116,7 @@ class AIchemyModel(object, metaclass=ABCMeta):
         print("Loaded {nr_models} models.".format(nr_models=nr_models))
         return models
 
-    def load_scores(self):
+    def _load_legacy_scores(self):
         # Number of classes is amount of model files, divided by model count
         #  minus 1, as 1 file is classification file
         nr_models = self.config.nr_models
@@ -110,62 +144,213 @@ class AIchemyModel(object, metaclass=ABCMeta):
         return getattr(self, key)
 
     def _get_dataframe(self, label):
-        if self.auto_mode:
-            if self.auto_save_preproc:
+        if self.auto_mode and isinstance(self.data[label], AIchemyDataset):
+            dataframe = self.data[label].to_dataframe()
+        else:
+            if self.auto_mode:
                 file_path = self.data[label]
-                dataframe = read_dataframe(file_path)
             else:
-                dataframe = self.data[label]
-        else:
-            file_path = self.infile
-            dataframe = read_dataframe(file_path)
+                file_path = self.infile
+            dataframe = read_dataframe(file_path, nr_cores=self.nr_cores, cache=self.cache)
         return dataframe
 
+    def _get_arrays(self, label):
+        """Returns the ids, classes and features of a dataset. The features
+        are a CSR matrix when the classifier is configured as sparse.
+        """
+        sparse = getattr(self.config, 'sparse', False)
+        if self.auto_mode and isinstance(self.data[label], AIchemyDataset):
+            # Gathers the rows of the view straight into arrays, without a dataframe in between.
+            ids, labels, features = self.data[label].to_arrays()
+        elif sparse:
+            if self.auto_mode:
+                return read_sparse(self.data[label], nr_cores=self.nr_cores, cache=self.cache)
+            else:
+                return read_sparse(self.infile, nr_cores=self.nr_cores, cache=self.cache)
+        else:
+            dataframe = self._get_dataframe(label)
+            ids = compact_ids(dataframe['id'])
+            labels = dataframe['class'].to_numpy()
+            features = dataframe.iloc[:, 2:].to_numpy(dtype=np.uint8)
+
+        if sparse:
+            from scipy import sparse as sp
+            features = sp.csr_matrix(features)
+        return ids, labels, features
+
+    def _iter_arrays(self, label, block_size):
+        """Yields the ids, classes and 0/1 uint8 features of a dataset in
+        blocks of block_size rows. Files are read one block at a time.
+        """
+        if self.auto_mode and isinstance(self.data[label], AIchemyDataset):
+            yield from self.data[label].iter_blocks(block_size)
+            return
+
+        infile = self.data[label] if self.auto_mode else self.infile
+        for dataframe in read_dataframe(infile, chunksize=block_size, cache=self.cache):
+            yield compact_ids(dataframe['id']), dataframe['class'].to_numpy(), \
+                dataframe.iloc[:, 2:].to_numpy(dtype=np.uint8)
+
+    def _estimate(self, label):
+        """Returns the (estimated) number of rows and features of a dataset without reading it."""
+        if self.auto_mode and isinstance(self.data[label], AIchemyDataset):
+            return len(self.data[label]), self.data[label].nr_features
+        nr_rows, nr_features, _, _ = self.planner.estimate(self.data[label] if self.auto_mode else self.infile)
+        return nr_rows, nr_features
+
+    def _get_packed_arrays(self, label):
+        """Returns the ids, classes, bit-packed features and number of
+        features of a dataset. Packed datasets aren't unpacked on the way.
+        """
+        if self.auto_mode and isinstance(self.data[label], AIchemyDataset):
+            dataset = self.data[label]
+        else:
+            infile = self.data[label] if self.auto_mode else self.infile
+            dataset = AIchemyDataset.from_file(infile, nr_cores=self.nr_cores, cache=self.cache, packed=True)
+        return dataset.ids, dataset.labels, dataset.get_packed_features(), dataset.nr_features
+
 
-# Todo: Make it work in current framework, with dataframes
 class ModelRNDFOR(AIchemyModel):
     def __init__(self, database):
         super(ModelRNDFOR, self).__init__(database, 'rndfor')
         if database.args.outfile2:
             self.outfile_train = database.args.outfile2
+        else:
+            self.outfile_train = None
 
     def build(self, models=None):
         """Trains NR_MODELS models and saves them as compressed files
         in the MODELS_PATH directory along with the calibration
-        conformity scores.
+        conformity scores. With parallel_models configured the models are
+        trained in a process pool, see _build_parallel.
         """
-        from aichemy.utils import shuffle_arrays_in_unison
-
         nr_models = self.config.nr_models
         prop_train_ratio = self.config.prop_train_ratio
 
-        train_dataframe = self._get_dataframe('train')
-
-        train_id_dataframe, train_data_dataframe = split_dataframe(train_dataframe, index=2, axis=1)
-        train_id = np.array([np.array(row.tolist()) for _, row in train_id_dataframe.iterrows()])
-        train_data = np.array([np.array(row.tolist()) for _, row in train_data_dataframe.iterrows()])
+        train_id, train_labels, train_data = self._get_arrays('train')
         nr_of_training_samples = len(train_id)
+        if models is None:
+            self.artifact.clear()
+
+        nr_parallel, n_jobs = self._plan_parallel_models(train_data)
+        if nr_parallel > 1:
+            self._build_parallel(models, train_labels, train_data, nr_parallel, n_jobs)
+            return
+
         for model_iteration in range(nr_models):
             if models is None:
                 model = self.reset()
             else:
                 model = models[model_iteration]
-            # Shuffling the sample_IDs and data of the training
-            #  set in unison, without creating copies.
-            shuffle_arrays_in_unison(train_id, train_data)
-            # Splitting training data into proper train set and
-            #  calibration set.
-            prop_train_data, calibration_data = split_array(train_data,
-                                                            array_size=nr_of_training_samples,
-                                                            percent_to_first=prop_train_ratio)
+            # Splitting a shuffled order of the training samples into
+            #  proper train set and calibration set indices.
+            prop_train_indices, calibration_indices = split_array(np.random.permutation(nr_of_training_samples),
+                                                                  percent_to_first=prop_train_ratio)
 
             print(f"Now building model: {model_iteration}")
-            model.fit(prop_train_data[:, 1:], prop_train_data[:, 0])
+            model.fit(train_data[prop_train_indices], train_labels[prop_train_indices])
             # Saving models to disk.
-            self.save_models(model_iteration)
+            self.save_models(model, model_iteration)
 
             # Retrieving the calibration conformity scores.
-            self.save_scores(calibration_data, model_iteration)
+            calibration_alphas = self.save_scores(train_data[calibration_indices], train_labels[calibration_indices],
+                                                  model_iteration, model)
+            self.save_tables(model.get_p_value_tables(calibration_alphas), model_iteration)
+
+    def _plan_parallel_models(self, train_data):
+        """Returns how many models are trained at once and the number of
+        cores of each. The cores of n_jobs are split evenly between the
+        parallel_models models, fewer are trained at once when their float32
+        proper train sets don't fit in the memory budget together.
+        """
+        nr_parallel = max(1, min(self.config.parallel_models, self.config.nr_models))
+        if self.config.n_jobs > 0:
+            nr_cores = self.config.n_jobs
+        else:
+            # Negative n_jobs count back from all cores, as in sklearn.
+            nr_cores = max(1, os.cpu_count() + 1 + self.config.n_jobs)
+
+        if nr_parallel > 1:
+            if issparse(train_data):
+                member_bytes = train_data.nnz * 12 * self.config.prop_train_ratio
+            else:
+                member_bytes = train_data.size * 4 * self.config.prop_train_ratio
+            fitting = int(self.planner.memory // max(member_bytes, 1))
+            if fitting < nr_parallel:
+                print(f"Only {max(fitting, 1)} of {nr_parallel} parallel models fit in the memory budget")
+                nr_parallel = max(fitting, 1)
+        return nr_parallel, max(1, nr_cores // nr_parallel)
+
+    def _build_parallel(self, models, train_labels, train_data, nr_parallel, n_jobs):
+        """Trains the models nr_parallel at a time in a process pool, each
+        growing its trees on n_jobs cores. The training set is copied into
+        shared memory once and read by all workers. Every worker writes the
+        blobs of its model as soon as it's calibrated, the manifest is only
+        written here.
+        """
+        import multiprocessing as mp
+        from sklearn.base import clone
+
+        nr_models = self.config.nr_models
+        if issparse(train_data):
+            arrays = {'labels': train_labels, 'data': train_data.data, 'indices': train_data.indices,
+                      'indptr': train_data.indptr}
+        else:
+            arrays = {'labels': train_labels, 'features': train_data}
+        segment, descriptor = share_arrays(arrays)
+
+        tasks = []
+        for model_iteration in range(nr_models):
+            model = self.create_new() if models is None else models[model_iteration]
+            prop_train_indices, calibration_indices = split_array(np.random.permutation(len(train_labels)),
+                                                                  percent_to_first=self.config.prop_train_ratio)
+            tasks.append((self.artifact.path, model_iteration, clone(model).set_params(n_jobs=n_jobs), descriptor,
+                          train_data.shape, prop_train_indices, calibration_indices))
+
+        print(f"Building {nr_models} models, {nr_parallel} at a time on {n_jobs} cores each")
+        try:
+            with mp.get_context('spawn').Pool(nr_parallel) as pool:
+                for model_iteration, member in pool.imap_unordered(_build_member, tasks):
+                    self.artifact.add_member(model_iteration, member)
+                    print(f"Saved model: {model_iteration}")
+        finally:
+            segment.close()
+            segment.unlink()
+
+    def save_tables(self, tables, iteration=0):
+        """Saves the p-value lookup tables of a model next to its calibration scores."""
+        self.artifact.save_tables(iteration, table_arrays(tables))
+
+    def load_tables(self, nr_models, nr_class):
+        """Returns the p-value lookup tables of every model, or None for
+        models saved without them.
+        """
+        tables = []
+        for i in range(nr_models):
+            arrays = self.artifact.load_tables(i) if self.artifact.exists() else None
+            if arrays is not None:
+                tables.append([PValueTable.from_arrays(arrays, c) for c in range(nr_class)])
+            else:
+                print(f"No p-value tables found for model {i}, searching its calibration scores instead")
+                tables.append(None)
+        return tables
+
+    def load_forest(self, sparse=False):
+        """Returns the models and their trees compiled into a FlatForest
+        straight from the memory-mapped node arrays, without rebuilding the
+        trees of the models. The forest is None when the models have to
+        predict themselves, for sparse features or models saved without
+        their node arrays.
+        """
+        if sparse or not self.artifact.has_forests():
+            return self.load_models(), None
+
+        print(f"Loading models from {self.artifact.path}")
+        models = [self.artifact.load_model(i, trees=False) for i in range(len(self.artifact))]
+        forest = FlatForest.from_arrays([self.artifact.map_forest(i) for i in range(len(self.artifact))],
+                                        models[0].classes_)
+        print(f"Loaded {len(models)} models as a forest of {len(forest.roots)} trees.")
+        return models, forest
 
     def improve(self):
         models = self.load_models()
@@ -173,99 +358,61 @@ class ModelRNDFOR(AIchemyModel):
 
     def predict(self):
         """Reads the pickled models and calibration conformity scores.
-        Initializes a fixed size numpy array. Reads in nrow lines of the
-        input file and then predicts the samples in the batch with each
+        Predicts the test samples in batches planned by the planner with each
         ml_model. The median p-values are calculated and written out in the
-        outfile. This is performed until all lines in the infile are predicted.
+        outfile. This is performed until all samples are predicted.
         """
         outfile_path, outfile = os.path.split(self.outfile)
         if not os.path.isdir(outfile_path):
             os.mkdir(outfile_path)
 
-        test_dataframe = self._get_dataframe('test')
-        test_id, test_data = split_dataframe(test_dataframe, index=2, axis=1)
-        ncol = test_data.shape(1)
-
-        # Reading parameters
-        nrow = self.config.pred_nrow  # To control memory.
-
-        dir_files = os.listdir(self.models_dir)
-        nr_of_models = sum([1 for f in dir_files if f.startswith(f"{self.name}_rndfor")])
+        test_id, test_labels, test_data = self._get_arrays('test')
+        nr_of_test_samples = len(test_id)
 
         # Initializing list of pointers to model objects
         #  and calibration conformity score lists.
-        models = self.load_models()
+        models, forest = self.load_forest(sparse=issparse(test_data))
         calibration_alphas_c, nr_class = self.load_scores()
+        nr_of_models = len(models)
+        tables = self.load_tables(nr_of_models, nr_class)
 
-        with open(os.path.join(outfile_path, outfile), 'w+') as fout:
-            sample_id = np.empty(nrow, dtype=np.dtype('U50'))
-            predict_data = np.empty((nrow, ncol), dtype=int)
-
-            # Three dimensional class array
-            p_c_array = np.empty((nrow, nr_of_models, nr_class), dtype=float)
-            print(f"Allocated memory for an {nrow} X {ncol} array.")
-
-            for i, row in test_data.iterrows():
-                # Reading in nrow samples.
-                if i % nrow != nrow - 1:
-                    # Inserting data from the infile into np.arrays.
-                    (sample_id[i % nrow],
-                     sample_data) = row.strip().split(None, 1)
-                    predict_data[i % nrow] = sample_data.split()
+        # The flat forest follows every (sample, tree) pair of a batch at once, while the models cast the features to
+        #  float32. A configured pred_nrow fixes the batch size, otherwise it's planned from the memory budget.
+        if forest is not None:
+            row_bytes = test_data.shape[1] / 8 + len(forest.roots) * (24 + 4 * nr_class)
+        else:
+            row_bytes = 5 * test_data.shape[1]
+        row_bytes += 8 * nr_class * (nr_of_models + 3)
+        plan = self.planner.plan_batches('rndfor predict', nr_of_test_samples, row_bytes, self.config.pred_nrow)
+
+        with open(os.path.join(outfile_path, outfile), 'w+') as fout, self.planner.track(plan) as stage:
+            class_string = "\t".join(['p(%d)' % c for c in range(nr_class)])
+            fout.write(f"sampleID\treal_class\t{class_string}\n")
+
+            for batch_start, batch_end in stage.batches(nr_of_test_samples):
+                batch_size = batch_end - batch_start
+                predict_data = test_data[batch_start:batch_end]
+                predict_id = decode_ids(test_id[batch_start:batch_end])
+
+                if forest is not None:
+                    # The nonconformity scores of all models at once, as in ClassifierRF.nonconformity_scores.
+                    nonconf_scores = 1 - forest.predict_proba(np.packbits(predict_data, axis=1), packed=True)
                 else:
-                    (sample_id[i % nrow],
-                     sample_data) = row.strip().split(None, 1)
-                    predict_data[i % nrow] = sample_data.split()
-                    # The array has now been filled.
-                    for model_index, model in enumerate(models):
-                        # Predicting and getting p_values for each model
-                        #  and sample.
-                        predict_alphas = model.nonconformity_scores(predict_data[:, 1:])
-
-                        # Iterate over the classes
-                        for c, predict_alpha_c in enumerate(zip(*predict_alphas)):
-                            for sample_index in range(nrow):
-                                p_c = model.get_CP_p_value(predict_alpha_c[sample_index],
-                                                           calibration_alphas_c[c][model_index])
-
-                                p_c_array[sample_index, model_index, c] = p_c
-
-                        # Calculating median p for each sample in the array, class c
-                        p_c_medians = np.median(p_c_array, axis=1)
-
-                    # Writing out sample prediction.
-                    print(f"Predicted samples: {i + 1}.")
-                    for j in range(nrow):
-                        p_c_string = "\t".join([str(p_c_medians[j, c]) for c in range(nr_class)])
-                        fout.write(f"{sample_id[j]}\t"
-                                   f"{predict_data[j, 0]}\t"
-                                   f"{p_c_string}\n")
-
-            # After all samples have been read, the array still contains some
-            #  samples that have not been predicted, as the 'else' was never
-            #  encountered. These samples are handled and written out below.
-            if i % nrow != nrow - 1:
-                for model_index, model in enumerate(models):
-                    predict_alphas = model.nonconformity_scores(predict_data[:i % nrow + 1, 1:])
-
-                    # Iterate over the classes
-                    for c, predict_alpha_c in enumerate(zip(*predict_alphas)):
-
-                        for sample_index in range(i % nrow + 1):
-                            p_c = model.get_CP_p_value(predict_alpha_c[sample_index],
-                                                       calibration_alphas_c[c][model_index])
-
-                            p_c_array[sample_index, model_index, c] = p_c
-
-                # Calculate remaining p-value medians.
-                p_c_medians = np.median(p_c_array[:i % nrow + 1, :], axis=1)
-
-                # Writing out final samples predictions.
-                for i in range(i % nrow + 1):
-                    p_c_string = "\t".join([str(p_c_medians[i, c]) for c in range(nr_class)])
-                    fout.write(f"{sample_id[i]}\t"
-                               f"{predict_data[i, 0]}\t"
-                               f"{p_c_string}\n")
+                    nonconf_scores = np.stack([model.nonconformity_scores(predict_data) for model in models], axis=1)
+
+                # Three dimensional class array of the p-values of every sample, model and class.
+                p_c_array = np.stack([model.get_CP_p_values(nonconf_scores[:, model_index],
+                                                            [calibration_alphas_c[c][model_index]
+                                                             for c in range(nr_class)],
+                                                            tables[model_index])
+                                      for model_index, model in enumerate(models)], axis=1)
+
+                # Calculating median p for each sample in the array, class c
+                p_c_medians = np.median(p_c_array, axis=1)
+
+                # Writing out sample prediction.
+                fout.write(format_predictions(predict_id, test_labels[batch_start:batch_end], p_c_medians))
+                print(f"Predicted samples: {batch_end}.")
 
     # Todo: Make validate submode work in current framework
     def validate(self):
@@ -280,7 +427,7 @@ class ModelRNDFOR(AIchemyModel):
 
         # Reading in file to use for validation.
         data_type = self.config.data_type
-        val_id, val_data = read_array(self.infile, data_type)
+        val_id, val_data = read_array(self.infile, data_type, nr_cores=self.nr_cores, cache=self.cache)
         nr_of_val_samples = len(val_id)
         val_indices = np.array(range(nr_of_val_samples))
         nr_holdout_samples = int(nr_of_val_samples / val_folds)
@@ -337,48 +484,31 @@ class ModelRNDFOR(AIchemyModel):
                 calibration_alphas_c = []
 
                 # Retrieving the calibration conformity scores.
-                for c, alpha_c in enumerate(model.cali_nonconf_scores(calibration_data)):
+                for c, alpha_c in enumerate(model.cali_nonconf_scores(calibration_data[:, 1:],
+                                                                      calibration_data[:, 0])):
                     calibration_alphas_c.append(alpha_c)
 
                 test_alphas = model.nonconformity_scores(test_data[:, 1:])
                 if self.outfile_train:
                     training_alphas = model.nonconformity_scores(training_data[:, 1:])
 
-                # Iterate over the classes.
-                for c, test_alpha_c in enumerate(zip(*test_alphas)):
-                    for sample_index in range(nr_of_test_samples):
-                        p_c = model.get_CP_p_value(test_alpha_c[sample_index],
-                                                   calibration_alphas_c[c])
-
-                        p_c_array[sample_index, model_iteration, c] = p_c
-
-                # Iterate over the classes for the training samples.
+                tables = model.get_p_value_tables(calibration_alphas_c)
+                p_c_array[:, model_iteration] = model.get_CP_p_values(test_alphas, calibration_alphas_c, tables)
                 if self.outfile_train:
-                    for c, training_alpha_c in enumerate(zip(*training_alphas)):
-                        for sample_index in range(nr_of_training_samples):
-                            p_c = model.get_CP_p_value(training_alpha_c[sample_index],
-                                                       calibration_alphas_c[c])
-
-                            p_c_array_training[sample_index, model_iteration, c] = p_c
+                    p_c_array_training[:, model_iteration] = model.get_CP_p_values(training_alphas,
+                                                                                   calibration_alphas_c, tables)
 
             # Calculating median p for each sample in the array, class c
             p_c_medians = np.median(p_c_array, axis=1)
 
             # Writing out sample prediction.
-            for i in range(nr_of_test_samples):
-                p_c_string = "\t".join([str(p_c_medians[i, c]) for c in range(nr_class)])
-                fout_test.write(f"{test_id[i]}\t"
-                                f"{test_data[i, 0]}\t"
-                                f"{p_c_string}\n")
+            fout_test.write(format_predictions(decode_ids(test_id), test_data[:, 0], p_c_medians))
 
             # Calculating median p for each sample in the array, class c
             if self.outfile_train:
                 p_c_medians_training = np.median(p_c_array_training, axis=1)
-                for i in range(nr_of_training_samples):
-                    p_c_string = "\t".join([str(p_c_medians_training[i, c]) for c in range(nr_class)])
-                    fout_train.write(f"{training_id[i]}\t"
-                                     f"{training_data[i, 0]}\t"
-                                     f"{p_c_string}\n")
+                fout_train.write(format_predictions(decode_ids(training_id), training_data[:, 0],
+                                                    p_c_medians_training))
 
         fout_test.close()
         if self.outfile_train:
@@ -404,131 +534,358 @@ class ModelNN(AIchemyModel):
         self.optimizer = eval(self.config.optimizer)
 
     def build(self, models=None):
-        from skorch import NeuralNetClassifier
-        from skorch.callbacks import EarlyStopping, EpochScoring
-        from skorch.dataset import Dataset
-        from skorch.helper import predefined_split
-        from torch import nn
-        from torch import FloatTensor
-
-        from libs.nonconformist.base import ClassifierAdapter
-        from libs.nonconformist.icp import IcpClassifier
-        from libs.nonconformist.nc import ClassifierNc, MarginErrFunc
-
-        train_dataframe = self._get_dataframe('train')
-
-        nr_models = self.config.nr_models
-        val_ratio = self.config.val_ratio
-        cal_ratio = self.config.cal_ratio
-        batch_size = self.config.batch_size
-        max_epochs = self.config.max_epochs
-        optimizer_learn_rate = self.config.optimizer_learn_rate
-        optimizer_weight_decay = self.config.optimizer_weight_decay
-        early_stop_patience = self.config.early_stop_patience
-        early_stop_threshold = self.config.early_stop_threshold
+        """Trains NR_MODELS nets as inductive conformal predictors and saves
+        them in the MODELS_PATH directory. With parallel_nets configured
+        the nets are trained in a process pool, see _build_parallel.
+        """
+        _, train_labels, train_features, nr_features = self._get_packed_arrays('train')
+        self.artifact.clear()
         self._set_optimizer()
 
-        X = np.array(train_dataframe.iloc[:, 2:]).astype(np.float32)
-        y = np.array(train_dataframe['class']).astype(np.int64)
-
+        nr_models = self.config.nr_models
+        nr_parallel = max(1, min(self.config.parallel_nets, nr_models))
+        # The features stay bit-packed, every set is an index array into them and only a mini-batch at a time is
+        #  unpacked to float32, by collate_fingerprints.
+        y = train_labels.astype(np.int64)
+        if nr_parallel > 1:
+            self._build_parallel(models, y, train_features, nr_features, nr_parallel)
+            return
+
+        train_dataset = FingerprintDataset(train_features, y, nr_features=nr_features,
+                                           as_bit_indices=self.config.sparse_input)
         for i in range(nr_models):
             if models is None:
                 classifier = self.reset()
             else:
                 classifier = models[i]
 
-            # Setup proper training, calibration and validation sets
-
-            # validation set created
-            total_train = np.arange(len(train_dataframe.index))
-            valid_set, train_set = split_array(total_train, val_ratio, shuffle=True)
-
-            # calib set and proper training set created
-            calib_set, proper_train_set = split_array(train_set, cal_ratio, shuffle=True)
-
-            # Convert validation to skorch dataset
-            valid_dataset = Dataset(X[valid_set], y[valid_set])
-
-            # Calculate number of training examples for each class (for weights)
-            nr_class0 = len([x for x in y[proper_train_set] if x == 0])
-            nr_class1 = len([x for x in y[proper_train_set] if x == 1])
-
-            # Setup for class weights
-            class_weights = 1 / FloatTensor([nr_class0, nr_class1])
-
-            # Define the skorch classifier
-            minus_ba = EpochScoring(minus_bacc,
-                                    name='-BA',
-                                    on_train=False,
-                                    use_caching=False,
-                                    lower_is_better=True)
-
-            early_stop = EarlyStopping(patience=early_stop_patience,
-                                       threshold=early_stop_threshold,
-                                       threshold_mode='rel',
-                                       lower_is_better=True)
+            print(f"\nWorking on model {i}")
+            icp = train_icp(classifier, train_dataset, *self._split_sets(len(y)), self.config, self.optimizer)
+            self.save_models(model=icp, iteration=i)
+            self.save_script(icp, iteration=i)
 
-            model = NeuralNetClassifier(classifier, batch_size=batch_size, max_epochs=max_epochs,
-                                        train_split=predefined_split(valid_dataset),  # Use predefined validation set
-                                        optimizer=self.optimizer,
-                                        optimizer__lr=optimizer_learn_rate,
-                                        optimizer__weight_decay=optimizer_weight_decay,
-                                        criterion=nn.CrossEntropyLoss,
-                                        criterion__weight=class_weights,
-                                        callbacks=[minus_ba, early_stop])
+    def save_script(self, icp, iteration=0):
+        """Saves the net of an ICP compiled with TorchScript and its
+        calibration scores, which predict uses without skorch.
+        """
+        script, calibration_scores = script_icp(icp)
+        self.artifact.save_script(iteration, script)
+        self.artifact.save_calibration(iteration, [calibration_scores])
+
+    def load_scripts(self):
+        print(f"Loading compiled models from {self.artifact.path}")
+        models = [ScriptedICP.from_bytes(self.artifact.load_script(i), self.artifact.load_calibration(i)[0])
+                  for i in range(len(self.artifact))]
+        print(f"Loaded {len(models)} models.")
+        return models
 
-            print(f"\nSize of model is {get_size(model)} bytes")
+    def _split_sets(self, nr_samples):
+        """Returns the validation, calibration and proper training set of a
+        model as indices into the training set.
+        """
+        # validation set created
+        total_train = np.arange(nr_samples)
+        valid_set, train_set = split_array(total_train, self.config.val_ratio, shuffle=True)
+
+        # calib set and proper training set created
+        calib_set, proper_train_set = split_array(train_set, self.config.cal_ratio, shuffle=True)
+        return valid_set, calib_set, proper_train_set
+
+    def _build_parallel(self, models, y, train_features, nr_features, nr_parallel):
+        """Trains the nets nr_parallel at a time in a process pool. The cores
+        are split evenly between the workers with torch.set_num_threads, as
+        the intra-op threads of one small net don't scale to many cores.
+        The packed features are copied into shared memory once and read by
+        all workers. Every worker writes its ICP as soon as it's calibrated,
+        the manifest is only written here.
+        """
+        import copy
+        import multiprocessing as mp
+        from concurrent.futures import ProcessPoolExecutor, as_completed
 
-            print(f"\nWorking on model {i}")
-            icp = IcpClassifier(ClassifierNc(ClassifierAdapter(model), MarginErrFunc()))
-            icp.fit(X[proper_train_set], y[proper_train_set])
-            icp.calibrate(X[calib_set], y[calib_set])
+        nr_models = self.config.nr_models
+        nr_threads = max(1, os.cpu_count() // nr_parallel)
+        segment, descriptor = share_arrays({'labels': y, 'features': train_features})
 
-            self.save_models(model=icp, iteration=i)
+        tasks = []
+        for i in range(nr_models):
+            # Every net starts from its own initial weights.
+            classifier = copy.deepcopy(self.reset()) if models is None else models[i]
+            tasks.append((self.artifact.path, i, classifier, descriptor, nr_features, self.config, self.optimizer,
+                          nr_threads, self._split_sets(len(y))))
+
+        print(f"Building {nr_models} models, {nr_parallel} at a time on {nr_threads} threads each")
+        try:
+            # Unlike a Pool, the executor fails with BrokenProcessPool when a worker dies instead of waiting for it.
+            with ProcessPoolExecutor(nr_parallel, mp_context=mp.get_context('spawn')) as executor:
+                for future in as_completed([executor.submit(_build_nn_member, task) for task in tasks]):
+                    i, member = future.result()
+                    self.artifact.add_member(i, member)
+                    print(f"Saved model: {i}")
+        finally:
+            segment.close()
+            segment.unlink()
 
     def improve(self):
         models = self.load_models()
         self.build(models)
 
     def predict(self):
-        import pandas as pd
-
-        test_dataframe = self._get_dataframe('test')
-        nr_models = self.config.nr_models
+        """Predicts the test samples block by block, reading one block of the
+        input at a time. The p-values of all models are stacked in one
+        array per block, their median is taken once and written out before
+        the next block is read. The nets compiled at build are used when the
+        ensemble has them.
+        """
         sig = self.config.pred_sig
+        nr_class = self.config.dim_out
 
-        models = self.load_models()
-
-        X = np.array(test_dataframe.iloc[:, 2:]).astype(np.float32)
-
-        p_value_results = []
-        for i in range(nr_models):
-            icp = models[i]
-
-            print(f"Predicting from model {i}")
-
-            pred = icp.predict(X, significance=sig)
-            pred = np.round(pred, 6).astype('str')
-
-            p_value = {'P(0)': pred[:, 0].tolist(),
-                       'P(1)': pred[:, 1].tolist()
-                       }
-
-            p_value_results.append(pd.DataFrame(p_value).astype('float32'))
-
-        p_value_dataframe = pd.concat(p_value_results, axis=1).groupby(level=0, axis=1).median()
-        results_dataframe = pd.concat([test_dataframe['id'], test_dataframe['class'], p_value_dataframe],
-                                      axis=1)
+        # The compiled nets predict without skorch and nonconformist, ensembles built before them are unpickled.
+        if self.artifact.has_scripts():
+            models = self.load_scripts()
+        else:
+            models = self.load_models()
+        nr_models = len(models)
+
+        # A block is held as uint8 features, cast to float32 for the nets, next to the p-values of every model. Nets
+        #  with sparse_input get the indices of the set bits instead.
+        nr_of_test_samples, nr_features = self._estimate('test')
+        row_bytes = 5 * nr_features + 8 * nr_class * (nr_models + 1)
+        plan = self.planner.plan_batches('nn predict', nr_of_test_samples, row_bytes)
+
+        with open(self.outfile, 'w+') as fout, self.planner.track(plan):
+            class_string = "\t".join(['p(%d)' % c for c in range(nr_class)])
+            fout.write(f"sampleID\treal_class\t{class_string}\n")
+
+            nr_predicted = 0
+            for test_id, test_labels, test_data in self._iter_arrays('test', plan.batch_size):
+                if self.config.sparse_input:
+                    X = bit_indices(test_data)
+                else:
+                    X = test_data.astype(np.float32)
+                p_values = np.empty((len(X), nr_models, nr_class))
+                for i, icp in enumerate(models):
+                    print(f"Predicting from model {i}")
+                    p_values[:, i] = icp.predict(X, significance=sig)
 
-        results_dataframe.to_csv(self.outfile, sep='\t', mode='w+', index=False, header=True)
+                fout.write(format_predictions(decode_ids(test_id), test_labels, np.median(p_values, axis=1)))
+                nr_predicted += len(X)
+                print(f"Predicted samples: {nr_predicted}.")
 
     # Todo: Implement validate submode for nn
     def validate(self):
         raise NotImplementedError("Validation for neural network models aren't implemented yet.")
 
 
+class ScriptedICP(object):
+    """The net of an ICP compiled with TorchScript and its ascending
+    calibration scores. Predicts the p-values of IcpClassifier with the
+    margin error function with numpy, without skorch and nonconformist.
+    """
+    def __init__(self, module, calibration_scores, nr_features, bit_input=False, smoothing=True):
+        self.module = module
+        self.calibration_scores = calibration_scores
+        self.nr_features = nr_features
+        self.bit_input = bit_input
+        self.smoothing = smoothing
+
+    @classmethod
+    def from_bytes(cls, data, calibration_scores):
+        import torch
+
+        extra_files = {SCRIPT_META: ''}
+        module = torch.jit.load(io.BytesIO(data), _extra_files=extra_files)
+        meta = json.loads(extra_files[SCRIPT_META])
+        return cls(module, calibration_scores, meta['nr_features'], bit_input=meta['input'] == 'bit_indices',
+                   smoothing=meta['smoothing'])
+
+    def predict(self, x, significance=None):
+        """Returns the p-value of every sample for every class, or whether it
+        is over the significance when one is given. x are float features or
+        bit indices, converted to the input the net was compiled for.
+        """
+        import torch
+
+        if self.bit_input and np.issubdtype(x.dtype, np.floating):
+            x = bit_indices(x)
+        elif not self.bit_input and not np.issubdtype(x.dtype, np.floating):
+            x = bit_features(x, self.nr_features)
+        with torch.no_grad():
+            # The float32 softmax skorch's predict_proba applies for the cross entropy loss, as the calibration
+            #  scores were computed with it.
+            probabilities = torch.softmax(self.module(torch.from_numpy(x)), dim=-1).numpy()
+        p_values = icp_p_values(margin_nonconformity(probabilities), self.calibration_scores, self.smoothing)
+        if significance is not None:
+            return p_values > significance
+        return p_values
+
+
+def table_arrays(tables):
+    """Returns the p-value tables of all classes of a model as one dict of arrays."""
+    arrays = {}
+    for c, table in enumerate(tables):
+        arrays.update(table.to_arrays(c))
+    return arrays
+
+
+def _build_member(task):
+    """Trains and calibrates one model of a random forest ensemble on the
+    shared training set, in a worker of ModelRNDFOR._build_parallel. Writes
+    the blobs of the model and returns its index and manifest entry.
+    """
+    path, iteration, model, descriptor, shape, prop_train_indices, calibration_indices = task
+    segment, arrays = attach_arrays(descriptor)
+    try:
+        print(f"Now building model: {iteration}")
+        calibration_alphas = _fit_member(model, arrays, shape, prop_train_indices, calibration_indices)
+    finally:
+        del arrays
+        segment.close()
+
+    member = EnsembleArtifact(path).write_member(iteration, model, calibration_alphas,
+                                                 table_arrays(model.get_p_value_tables(calibration_alphas)))
+    return iteration, member
+
+
+def _fit_member(model, arrays, shape, prop_train_indices, calibration_indices):
+    # The views of the shared arrays only live in this frame, so the segment can be closed after it.
+    labels = arrays['labels']
+    if 'features' in arrays:
+        features = arrays['features']
+    else:
+        from scipy.sparse import csr_matrix
+        features = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape)
+    model.fit(features[prop_train_indices], labels[prop_train_indices])
+    return list(model.cali_nonconf_scores(features[calibration_indices], labels[calibration_indices]))
+
+
+def train_icp(classifier, train_dataset, valid_set, calib_set, proper_train_set, config, optimizer):
+    """Trains a net on the proper training set of train_dataset, with early
+    stopping on the validation set, and returns it calibrated as an ICP.
+    """
+    from skorch import NeuralNetClassifier
+    from skorch.callbacks import EarlyStopping, EpochScoring
+    from skorch.helper import predefined_split
+    from torch import nn
+    from torch import FloatTensor
+
+    from libs.nonconformist.base import ClassifierAdapter
+    from libs.nonconformist.icp import IcpClassifier
+    from libs.nonconformist.nc import ClassifierNc, MarginErrFunc
+
+    y = train_dataset.labels
+    valid_dataset = train_dataset.subset(valid_set)
+
+    # Calculate number of training examples for each class (for weights)
+    nr_class0 = np.count_nonzero(y[proper_train_set] == 0)
+    nr_class1 = np.count_nonzero(y[proper_train_set] == 1)
+
+    # Setup for class weights
+    class_weights = 1 / FloatTensor([nr_class0, nr_class1])
+
+    # Define the skorch classifier
+    minus_ba = EpochScoring(minus_bacc,
+                            name='-BA',
+                            on_train=False,
+                            use_caching=False,
+                            lower_is_better=True)
+
+    early_stop = EarlyStopping(patience=config.early_stop_patience,
+                               threshold=config.early_stop_threshold,
+                               threshold_mode='rel',
+                               lower_is_better=True)
+
+    model = NeuralNetClassifier(classifier, batch_size=config.batch_size, max_epochs=config.max_epochs,
+                                train_split=predefined_split(valid_dataset),  # Use predefined validation set
+                                optimizer=optimizer,
+                                optimizer__lr=config.optimizer_learn_rate,
+                                optimizer__weight_decay=config.optimizer_weight_decay,
+                                criterion=nn.CrossEntropyLoss,
+                                criterion__weight=class_weights,
+                                iterator_train__collate_fn=collate_fingerprints,
+                                iterator_valid__collate_fn=collate_fingerprints,
+                                callbacks=[minus_ba, early_stop])
+
+    print(f"\nSize of model is {get_size(model)} bytes")
+
+    icp = IcpClassifier(ClassifierNc(ClassifierAdapter(model), MarginErrFunc()))
+    icp.fit(train_dataset.subset(proper_train_set), y[proper_train_set])
+    icp.calibrate(train_dataset.subset(calib_set), y[calib_set])
+
+    # The validation and calibration sets share the features of the whole training set, only their scores are
+    #  saved with the model. The adapter caches the last input it predicted, the calibration set.
+    model.train_split = None
+    icp.cal_x = None
+    adapter = icp.nc_function.model
+    adapter.last_x = adapter.last_y = None
+    adapter.clean = False
+    return icp
+
+
+def script_icp(icp):
+    """Compiles the net of a calibrated ICP with TorchScript. Returns the
+    saved module, with its input format, number of features and smoothing
+    as an extra file, and the ascending calibration scores of the ICP.
+    """
+    import torch
+
+    module = icp.nc_function.model.model.module_.eval()
+    bit_input = isinstance(module.fc[0], BitEmbedding)
+    if bit_input:
+        example = torch.zeros((2, 1), dtype=torch.int64)
+    else:
+        example = torch.zeros((2, module.layer_dimensions[0]))
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example)
+
+    meta = {'input': 'bit_indices' if bit_input else 'dense', 'nr_features': module.layer_dimensions[0],
+            'smoothing': bool(icp.smoothing)}
+    buffer = io.BytesIO()
+    torch.jit.save(traced, buffer, _extra_files={SCRIPT_META: json.dumps(meta)})
+    # nonconformist keeps the scores in descending order.
+    return buffer.getvalue(), np.sort(icp.cal_scores[0])
+
+
+def bit_features(indices, nr_features):
+    """Returns the float32 0/1 features of the padded bit indices of bit_indices."""
+    features = np.zeros((len(indices), nr_features + 1), dtype=np.float32)
+    features[np.arange(len(indices))[:, None], indices] = 1
+    return features[:, :-1]
+
+
+def _build_nn_member(task):
+    """Trains and calibrates one net of a neural network ensemble on the
+    shared training set, in a worker of ModelNN._build_parallel. Writes the
+    ICP and its compiled net and returns its index and manifest entry.
+    """
+    import torch
+
+    path, iteration, classifier, descriptor, nr_features, config, optimizer, nr_threads, sets = task
+    torch.set_num_threads(nr_threads)
+    segment, arrays = attach_arrays(descriptor)
+    print(f"\nWorking on model {iteration}")
+    train_dataset = FingerprintDataset(arrays['features'], arrays['labels'], nr_features=nr_features,
+                                       as_bit_indices=config.sparse_input)
+    icp = train_icp(classifier, train_dataset, *sets, config, optimizer)
+
+    # The member is pickled and compiled while the shared features are still mapped, and the segment is only closed
+    #  once nothing views it anymore. On an error it stays mapped until the worker exits.
+    script, calibration_scores = script_icp(icp)
+    member = EnsembleArtifact(path).write_member(iteration, icp, [calibration_scores], script=script)
+    del arrays, train_dataset, icp
+    segment.close()
+    return iteration, member
+
+
+def format_predictions(ids, labels, p_values):
+    """Formats the rows of a prediction file: the sample id, real class and p-value of each class."""
+    return "".join(f"{sample_id}\t{label}\t" + "\t".join(map(str, sample_p_values)) + "\n"
+                   for sample_id, label, sample_p_values in zip(ids, labels.tolist(), p_values.tolist()))
+
+
 def minus_bacc(net, X=None, y=None):
     from sklearn.metrics import balanced_accuracy_score
-    y_true = y
+    # The labels of a FingerprintDataset aren't split off by skorch.
+    y_true = y if y is not None else X.y
     y_pred = net.predict(X)
     return -balanced_accuracy_score(y_true, y_pred)
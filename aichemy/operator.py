@@ -26,6 +26,7 @@ class AIchemyOperator(object):
         elif self.mode == 'auto':
             from aichemy.preprocessing import PreProcAuto
             self.preproc = PreProcAuto(self.controller)
+            self.controller.auto_data = self.preproc.run()
             if self.controller.config.execute.auto_plus_sum or self.controller.config.execute.auto_plus_plot:
                 from aichemy.postprocessing import PostProcAuto
                 self.postproc = PostProcAuto(self.controller)
@@ -104,6 +105,7 @@ class AIchemyOperator(object):
                 model = self.get_model(classifier)
                 model.build()
                 model.predict()
+            self.preproc.wait_for_save()
 
         if self.mode == 'postproc' or self.mode in self.controller.auto_modes:
             self.postproc.start()
@@ -0,0 +1,228 @@
+import os
+import threading
+
+import numpy as np
+
+from aichemy.utils import open_file, is_binary_dataset, BinaryDataset, COMPRESSED_EXTENSIONS, PARSE_BLOCK_SIZE
+
+PLANNER_SAMPLE_LINES = 1000
+PLANNER_MEMORY_FRACTION = 0.5
+PLANNER_MIN_ROWS = 1000
+PLANNER_POLL_INTERVAL = 0.05
+# Memory of a row besides its features: the pandas string of the id and the class.
+ROW_OVERHEAD = 64
+# A selected or split block of rows is copied once before it's merged.
+PREPROC_COPY_FACTOR = 2
+
+
+class ExecutionPlanner(object):
+    """Chooses chunk sizes, batch sizes and worker counts from a memory budget.
+
+    The budget is given in GB, without one a fixed share of the memory that
+    is available when the planner is created is used. The size of a row in
+    memory is estimated from the first lines of the input, or from the meta
+    data of a binary dataset. Stages run under track, which records the
+    peak RSS of the process while they run and corrects the row size of
+    the following batches when the estimate was off.
+    """
+    def __init__(self, memory_budget=None):
+        if memory_budget:
+            self.memory = int(memory_budget * 2 ** 30)
+        else:
+            self.memory = int(get_available_memory() * PLANNER_MEMORY_FRACTION)
+        self.peaks = {}
+        self.corrections = {}
+
+    def estimate(self, infile):
+        """Returns the estimated number of rows, number of features, bytes per
+        line on disk and bytes per row in memory of a dataset.
+        """
+        if is_binary_dataset(infile):
+            dataset = BinaryDataset(infile)
+            nr_rows = len(dataset)
+            nr_features = dataset.nr_features
+            line_bytes = dataset.meta['id_width'] + 1 + dataset.meta['packed_width']
+            id_width = dataset.meta['id_width']
+        else:
+            with open(infile, 'rb') as raw, open_file(infile, 'rb', fileobj=raw) as fin:
+                lines = [line for _, line in zip(range(PLANNER_SAMPLE_LINES), fin) if line.strip()]
+                consumed = raw.tell()
+
+            if not lines:
+                return 0, 0, 0, 0
+            fields = lines[0].split()
+            nr_features = len(fields) - 2
+            line_bytes = sum(len(line) for line in lines) / len(lines)
+            id_width = max(len(line.split(maxsplit=1)[0]) for line in lines)
+            size = os.path.getsize(infile)
+            if os.path.splitext(infile)[1] in COMPRESSED_EXTENSIONS and consumed:
+                # The compression ratio of the first lines holds for the rest of the file.
+                size *= sum(len(line) for line in lines) / consumed
+            nr_rows = int(np.ceil(size / line_bytes))
+
+        row_bytes = nr_features + id_width + ROW_OVERHEAD
+        return nr_rows, nr_features, line_bytes, row_bytes
+
+    def plan_preprocessing(self, infile, chunksize=None, nr_cores=1):
+        """Plans a preprocessing run on infile. A given chunksize is kept
+        unless the whole file is smaller, otherwise chunks are only used
+        when the dataset doesn't fit in the budget.
+        """
+        nr_rows, nr_features, line_bytes, row_bytes = self.estimate(infile)
+        row_bytes = (line_bytes + row_bytes) * PREPROC_COPY_FACTOR * self.corrections.get('preprocessing', 1)
+        plan = ExecutionPlan('preprocessing', self.memory, nr_rows, row_bytes)
+        plan.fits = nr_rows * row_bytes <= self.memory
+        plan.nr_workers = int(max(1, min(nr_cores, self.memory // (row_bytes * PLANNER_MIN_ROWS))))
+
+        rows_per_worker = max(PLANNER_MIN_ROWS, int(self.memory // (row_bytes * plan.nr_workers)))
+        if chunksize and chunksize >= nr_rows:
+            print(f"The applied chunk size ({chunksize}) is bigger then the input file. Therefore the chunking will "
+                  f"disabled")
+            chunksize = None
+        elif chunksize is None and not plan.fits:
+            chunksize = rows_per_worker
+        plan.chunksize = chunksize
+
+        if chunksize and line_bytes:
+            plan.block_size = int(chunksize * line_bytes)
+        else:
+            plan.block_size = int(min(PARSE_BLOCK_SIZE, max(line_bytes, rows_per_worker * line_bytes)))
+        print(plan)
+        return plan
+
+    def plan_batches(self, name, nr_rows, row_bytes, batch_size=None):
+        """Plans the batches of a prediction stage. A given batch_size is used
+        as it is, otherwise the batches fill the budget and are resized while
+        the stage runs.
+        """
+        plan = ExecutionPlan(name, self.memory, nr_rows, row_bytes * self.corrections.get(name, 1))
+        plan.fixed = bool(batch_size)
+        if batch_size:
+            plan.batch_size = batch_size
+        else:
+            plan.batch_size = plan.get_batch_size()
+        print(plan)
+        return plan
+
+    def track(self, plan):
+        return StageTracker(self, plan)
+
+
+class ExecutionPlan(object):
+    def __init__(self, name, memory, nr_rows, row_bytes):
+        self.name = name
+        self.memory = memory
+        self.nr_rows = nr_rows
+        self.row_bytes = row_bytes
+        self.fits = True
+        self.fixed = False
+        self.nr_workers = 1
+        self.chunksize = None
+        self.block_size = None
+        self.batch_size = None
+
+    def __str__(self):
+        lines = [f"\nExecution plan for {self.name}",
+                 f"  memory budget: {format_bytes(self.memory)}",
+                 f"  estimated rows: {self.nr_rows} of {format_bytes(self.row_bytes)} each"]
+        if self.batch_size is None:
+            lines.append(f"  fits in memory: {self.fits}")
+            lines.append(f"  workers: {self.nr_workers}")
+            lines.append(f"  chunk size: {self.chunksize or 'whole file'}")
+            lines.append(f"  range size: {format_bytes(self.block_size)}")
+        else:
+            lines.append(f"  batch size: {self.batch_size}{' (configured)' if self.fixed else ''}")
+        return "\n".join(lines)
+
+    def get_batch_size(self):
+        return int(max(1, min(max(self.nr_rows, 1), self.memory // max(self.row_bytes, 1))))
+
+
+class StageTracker(object):
+    """Records the peak RSS of a stage by polling in a background thread.
+    Only the memory of this process is measured, not that of pool workers.
+    """
+    def __init__(self, planner, plan):
+        self.planner = planner
+        self.plan = plan
+        self.peak = 0
+        self._baseline = 0
+        self._start = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = self._baseline = self._start = get_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, get_rss())
+        self.planner.peaks[self.plan.name] = max(self.planner.peaks.get(self.plan.name, 0), self.peak)
+        print(f"Peak memory of {self.plan.name}: {format_bytes(self.peak)}, {format_bytes(self.peak - self._start)} "
+              f"above its start (budget {format_bytes(self.plan.memory)})")
+
+    def _poll(self):
+        while not self._stop.wait(PLANNER_POLL_INTERVAL):
+            self.peak = max(self.peak, get_rss())
+
+    def batches(self, nr_rows):
+        """Yields the (start, end) rows of each batch. After every batch the
+        row size is corrected with the peak RSS it caused, and the following
+        batches are resized to it unless the batch size is fixed.
+        """
+        start = 0
+        while start < nr_rows:
+            end = min(start + self.plan.batch_size, nr_rows)
+            self.peak = self._baseline = get_rss()
+            yield start, end
+            self.peak = max(self.peak, get_rss())
+            self.correct(end - start, self.peak - self._baseline)
+            start = end
+
+    def correct(self, nr_rows, used_bytes):
+        if nr_rows < PLANNER_MIN_ROWS or used_bytes <= 0:
+            # Too few rows to tell the memory of the rows from the noise.
+            return
+        # Freed memory of earlier batches is reused, so a single batch can't shrink the row size by much.
+        correction = min(max(used_bytes / nr_rows / self.plan.row_bytes, 0.5), 4)
+        self.plan.row_bytes *= correction
+        self.planner.corrections[self.plan.name] = self.planner.corrections.get(self.plan.name, 1) * correction
+        if not self.plan.fixed:
+            batch_size = self.plan.get_batch_size()
+            if batch_size != self.plan.batch_size:
+                print(f"Corrected the batch size of {self.plan.name} from {self.plan.batch_size} to {batch_size}")
+                self.plan.batch_size = batch_size
+
+
+def get_available_memory():
+    """Returns the available memory in bytes."""
+    try:
+        with open('/proc/meminfo') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_rss():
+    """Returns the resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_bytes(nr_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(nr_bytes) < 1024 or unit == 'GB':
+            return f"{nr_bytes:.1f} {unit}"
+        nr_bytes /= 1024
@@ -2,6 +2,7 @@ import os
 import re
 
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -235,44 +236,34 @@ def set_prediction(p0, p1, significance):
 def read_pred_file(infile, significance_list, error_level):
     """This function will calculate values for the confusion
     matrix and the set numbers based on a list of significance levels.
+    Only the class and p-value columns are read, the sample ids are skipped.
     """
 
     summary_array = np.zeros((error_level - 1, 8), dtype=int)
 
-    with open(infile, 'r') as fin:
-        next(fin)
-        for line in fin:
-            line_list = line.strip().split()
-            real_class = line_list[1]
-            p0 = float(line_list[2])
-            p1 = float(line_list[3])
-            set_preds = [set_prediction(p0, p1, significance) for significance in significance_list]
-
-            # Confusion matrix and set counts.
-            for i, set_pred in enumerate(set_preds):
-                if set_pred == '{0}':
-                    if real_class == '0' or real_class == '0.0':
-                        summary_array[i, 2] += 1  # true_neg
-                    elif real_class == '1' or real_class == '1.0':
-                        summary_array[i, 3] += 1  # false_neg
-
-                elif set_pred == '{0,1}':
-                    if real_class == '0' or real_class == '0.0':
-                        summary_array[i, 4] += 1  # both_class0
-                    elif real_class == '1' or real_class == '1.0':
-                        summary_array[i, 5] += 1  # both_class1
-
-                elif set_pred == '{}':
-                    if real_class == '0' or real_class == '0.0':
-                        summary_array[i, 6] += 1  # null_class0
-                    elif real_class == '1' or real_class == '1.0':
-                        summary_array[i, 7] += 1  # null_class1
-
-                elif set_pred == '{1}':
-                    if real_class == '1' or real_class == '1.0':
-                        summary_array[i, 0] += 1  # true_pos
-                    elif real_class == '0' or real_class == '0.0':
-                        summary_array[i, 1] += 1  # false_pos
+    predictions = pd.read_csv(infile, sep=r'\s+', header=None, skiprows=1, usecols=[1, 2, 3],
+                              dtype=np.float64, engine='c').to_numpy()
+    real_class, p0, p1 = predictions[:, 0], predictions[:, 1], predictions[:, 2]
+    class0 = real_class == 0
+    class1 = real_class == 1
+
+    # Confusion matrix and set counts.
+    for i, significance in enumerate(significance_list):
+        set0 = p0 > significance
+        set1 = p1 > significance
+        only0 = set0 & ~set1
+        only1 = ~set0 & set1
+        both = set0 & set1
+        empty = ~set0 & ~set1
+
+        summary_array[i, 0] = np.count_nonzero(only1 & class1)  # true_pos
+        summary_array[i, 1] = np.count_nonzero(only1 & class0)  # false_pos
+        summary_array[i, 2] = np.count_nonzero(only0 & class0)  # true_neg
+        summary_array[i, 3] = np.count_nonzero(only0 & class1)  # false_neg
+        summary_array[i, 4] = np.count_nonzero(both & class0)  # both_class0
+        summary_array[i, 5] = np.count_nonzero(both & class1)  # both_class1
+        summary_array[i, 6] = np.count_nonzero(empty & class0)  # null_class0
+        summary_array[i, 7] = np.count_nonzero(empty & class1)  # null_class1
 
     return summary_array
 
@@ -1,16 +1,23 @@
 import os
+import threading
 import numpy as np
 import pandas as pd
 
 from pandas.io.parsers import TextFileReader as Chunks
-from sklearn.utils import resample
 from random import randrange
 from abc import ABCMeta, abstractmethod
 
-from aichemy.utils import read_dataframe, save_dataframe, shuffle_dataframe, MutuallyExclusiveError, \
-    ModeError, NoMultiCoreSupportError
+from aichemy.utils import read_dataframe, read_sparse, save_dataframe, save_sparse, shuffle_dataframe, shuffle_file, \
+    convert_dataset, is_binary_dataset, decode_ids, get_byte_ranges, read_byte_range, parse_fingerprint_range, \
+    parse_labels, share_fingerprints, fetch_fingerprints, get_dataset_size, BinaryDataset, \
+    BinaryDatasetReader, ResultMerger, MutuallyExclusiveError, ModeError, NoMultiCoreSupportError, \
+    BINARY_DATASET_CHUNKSIZE, COMPRESSED_EXTENSIONS
+from aichemy.dataset import AIchemyDataset, balancing_indices, balancing_mask, sample_indices, split_indices, \
+    split_mask, trim_mask
 
-MULTICORE_SUPPORT = ['balancing', 'sample', 'auto']
+MULTICORE_SUPPORT = ['balancing', 'sample', 'split', 'trim', 'auto']
+SPARSE_SUPPORT = ['balancing', 'sample', 'split', 'trim']
+CHUNK_READERS = (Chunks, BinaryDatasetReader)
 
 # Todo: Make the provided outfile will be used correctly
 class AIchemyPreProc(object, metaclass=ABCMeta):
@@ -28,17 +35,57 @@ class AIchemyPreProc(object, metaclass=ABCMeta):
         self.outfile = controller.args.outfile
         self.outfile2 = controller.args.outfile2
         self.src_dir = controller.src_dir
+        self.cache = controller.cache
+        self.split_seed = controller.config.execute.split_seed
+        self.planner = controller.planner
+        self.memory_budget = self.planner.memory / 2 ** 30
+        self.plan = self.planner.plan_preprocessing(self.infile, self.chunksize, self.nr_cores)
+        self.chunksize = self.plan.chunksize
+        self.nr_cores = self.plan.nr_workers
+        # Split and trim read the whole input at once unless they are asked to work in chunks or on multiple cores, or
+        #  the input doesn't fit in the memory budget.
+        self.streaming = bool(self.chunksize) or self.nr_cores > 1
+        self._pool = None
+
+    def __getstate__(self):
+        # Bound methods like self.balancing are sent to the workers, the pool itself can't be.
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
 
     @abstractmethod
     def run(self):
         pass
 
     def _single_core(self, submode, dataframes=None, outfile=None, outfile2=None, save=True):
-        if dataframes is None:
-            self._check_chunksize()
-            dataframes = read_dataframe(self.infile, self.chunksize)
+        if submode == 'convert':
+            if outfile is None:
+                outfile = self.outfile
+            return convert_dataset(self.infile, outfile, self.chunksize)
+        elif submode == 'shuffle':
+            if outfile is None:
+                outfile = self.outfile
+            return shuffle_file(self.infile, outfile, memory_budget=self.memory_budget)
+
         if outfile is None:
             outfile = self.outfile
+        if dataframes is None and (submode == 'balancing' or submode == 'sample'):
+            return self._stream_select(submode, self._get_merger(outfile if save else None))
+        elif dataframes is None and self.streaming and submode == 'trim':
+            return self._stream_select(submode, self._get_merger(outfile if save else None, shuffle=self.shuffle))
+        elif dataframes is None and self.streaming and submode == 'split':
+            if outfile2 is None:
+                outfile2 = self.outfile2
+            return self._stream_split(self._get_merger(outfile if save else None, shuffle=self.shuffle),
+                                      self._get_merger(outfile2 if save else None, shuffle=self.shuffle))
+
+        if dataframes is None and (submode == 'split' or submode == 'trim'):
+            dataframes = AIchemyDataset.from_file(self.infile, nr_cores=self.nr_cores, cache=self.cache)
+        elif dataframes is None:
+            dataframes = read_dataframe(self.infile, self.chunksize, nr_cores=self.nr_cores, cache=self.cache)
+
+        if isinstance(dataframes, AIchemyDataset):
+            return self._dataset(submode, dataframes, outfile, outfile2, save)
 
         if submode == 'split':
             if outfile2 is None:
@@ -51,6 +98,9 @@ class AIchemyPreProc(object, metaclass=ABCMeta):
             else:
                 return dataframe_large, dataframe_small
 
+        elif (submode == 'balancing' or submode == 'sample') and save and isinstance(dataframes, CHUNK_READERS):
+            return self._sample_or_balancing(submode, dataframes, merger=self._get_merger(outfile))
+
         elif submode == 'trim' or submode == 'balancing' or submode == 'sample':
             utils = getattr(self, submode)
             dataframe = utils(dataframes)
@@ -64,47 +114,230 @@ class AIchemyPreProc(object, metaclass=ABCMeta):
             return dataframe
 
     def _multicore(self, submode, dataframes=None, outfile=None, outfile2=None, save=True):
-        import multiprocessing as mp
-        if submode in MULTICORE_SUPPORT:
-            if dataframes is None:
-                self._check_chunksize()
-                dataframes = read_dataframe(self.infile, self.chunksize)
+        if submode == 'split' or submode == 'trim':
+            return self._single_core(submode, dataframes, outfile, outfile2, save)
+        elif submode in MULTICORE_SUPPORT:
             if outfile is None:
                 outfile = self.outfile
 
-            dataframe = pd.DataFrame()
+            merger = self._get_merger(outfile if save else None)
             preproc = getattr(self, submode)
-            ctx = mp.get_context('spawn')
+            if isinstance(dataframes, pd.DataFrame):
+                # The rows are already parsed, shipping them to the workers would cost more than sampling them here.
+                merger.add(preproc(dataframes))
+                return merger.result()
+
+            if dataframes is None and submode != 'auto':
+                return self._stream_select(submode, merger)
+
+            if dataframes is None:
+                dataframes = read_dataframe(self.infile, self.chunksize, cache=self.cache)
+
             print(f"Starting multicore {submode} with {self.nr_cores} cores")
-            with ctx.Pool(self.nr_cores) as pool:
-                pool_stack = pool.imap_unordered(preproc, dataframes)
-                for i, pool_dataframe in enumerate(pool_stack):
-                    print(f"\nCombining pool dataframe {i}\n-----------------------------------")
-                    dataframe = pd.concat([dataframe, pool_dataframe])
-                pool.close()
-                pool.join()
-
-            dataframe = shuffle_dataframe(dataframe)
-            if save:
-                save_dataframe(dataframe, outfile)
-                return outfile
-            else:
-                return dataframe
+            for i, pool_dataframe in enumerate(self._get_pool().imap_unordered(preproc, dataframes)):
+                print(f"\nCombining pool dataframe {i}\n-----------------------------------")
+                merger.add(pool_dataframe)
+
+            return merger.result()
 
         else:
             raise NoMultiCoreSupportError(submode)
 
-    def _check_chunksize(self):
-        if self.chunksize:
-            with open(self.infile) as fin:
-                for i in range(self.chunksize):
-                    try:
-                        next(fin)
-                    except StopIteration:
-                        print(f"The applied chunk size ({self.chunksize}) is bigger then the input file. Therefore the "
-                              f"chunking will disabled")
-                        self.chunksize = None
-                        break
+    def _sparse(self, submode, outfile=None, outfile2=None):
+        """Runs a submode on CSR features, selecting rows by index instead
+        of through dataframes.
+        """
+        if submode not in SPARSE_SUPPORT:
+            raise ModeError(self.mode, submode)
+        if outfile is None:
+            outfile = self.outfile
+        if outfile2 is None:
+            outfile2 = self.outfile2
+
+        ids, labels, features = read_sparse(self.infile, nr_cores=self.nr_cores, cache=self.cache)
+        print(f"\nStart {submode} on sparse dataset")
+
+        if submode == 'balancing' or submode == 'sample':
+            if submode == 'balancing':
+                indices = balancing_indices(labels, percentage=self.percentage)
+            else:
+                indices = sample_indices(len(labels), percentage=self.percentage)
+            np.random.shuffle(indices)
+            save_sparse(ids[indices], labels[indices], features[indices], outfile)
+            return outfile
+
+        if self.shuffle:
+            indices = np.random.permutation(len(labels))
+        else:
+            indices = np.arange(len(labels))
+        indices_large, indices_small = split_indices(indices, percentage=self.percentage)
+        save_sparse(ids[indices_large], labels[indices_large], features[indices_large], outfile)
+        if submode == 'split':
+            save_sparse(ids[indices_small], labels[indices_small], features[indices_small], outfile2)
+            return outfile, outfile2
+        return outfile
+
+    def _dataset(self, submode, dataset, outfile, outfile2=None, save=True):
+        """Runs a submode on an AIchemyDataset. The results are views of the
+        dataset, its rows are only copied when they are saved.
+        """
+        print(f"\nStart {submode} on dataset")
+        if submode == 'split':
+            if outfile2 is None:
+                outfile2 = self.outfile2
+            dataset_large, dataset_small = dataset.split(self.percentage, shuffle=self.shuffle)
+            if save:
+                return dataset_large.save(outfile), dataset_small.save(outfile2)
+            return dataset_large, dataset_small
+        elif submode == 'trim':
+            dataset = dataset.trim(self.percentage, shuffle=self.shuffle)
+        elif submode == 'balancing':
+            dataset = dataset.balance(self.percentage)
+        elif submode == 'sample':
+            dataset = dataset.sample(self.percentage)
+        else:
+            raise ModeError(self.mode, submode)
+
+        if save:
+            return dataset.save(outfile)
+        return dataset
+
+    def _stream_select(self, submode, merger):
+        """Runs balancing, sample or trim on the input file range by range and
+        hands the selected rows to merger, so only one range per worker is
+        parsed at a time. Balancing and trim first read the classes of all
+        rows and fix which rows to keep, so the class ratios and the number of
+        rows hold for the whole file instead of for each range.
+        """
+        infile = self._get_stream_input()
+        if os.path.splitext(infile)[1] in COMPRESSED_EXTENSIONS:
+            return self._stream_select_chunks(submode, infile, merger)
+
+        nr_features = _get_nr_features(infile)
+        ranges = self._get_ranges(infile)
+
+        if submode == 'balancing' or submode == 'trim':
+            print(f"\nCounting classes of {infile}")
+            range_labels = list(self._map(_read_labels, [(infile, start, end) for start, end in ranges]))
+            mask = self._get_mask(submode, np.concatenate(range_labels))
+            offsets = np.cumsum([0] + [len(labels) for labels in range_labels])
+            selections = [mask[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        elif submode == 'sample':
+            selections = [self.percentage] * len(ranges)
+        else:
+            raise ModeError(self.mode, submode)
+
+        tasks = [(infile, start, end, nr_features, selection) for (start, end), selection in zip(ranges, selections)]
+        print(f"\nStart {submode} on {len(tasks)} ranges with {self.nr_cores} cores")
+        # Trim keeps the rows in their original order, so the ranges have to arrive in order.
+        results = self._map(_select_rows, tasks, ordered=(submode == 'trim'))
+        for i, (result, packed, nr_features) in enumerate(results):
+            print(f"\nCombining range {i}\n-----------------------------------")
+            merger.add_fingerprints(*fetch_fingerprints(result), packed=packed, nr_features=nr_features)
+        return merger.result()
+
+    def _stream_select_chunks(self, submode, infile, merger):
+        """Compressed files can't be split into byte ranges, so they are read
+        twice as a stream of chunks instead.
+        """
+        chunksize = self.chunksize or BINARY_DATASET_CHUNKSIZE
+        mask = None
+        if submode == 'balancing' or submode == 'trim':
+            print(f"\nCounting classes of {infile}")
+            labels = np.concatenate([chunk.iloc[:, 0].to_numpy(dtype=np.int8) for chunk in
+                                     pd.read_csv(infile, sep=r'\s+', header=None, usecols=[1], chunksize=chunksize)])
+            mask = self._get_mask(submode, labels)
+
+        print(f"\nStart {submode} in chunks with size {chunksize} rows")
+        row = 0
+        for i, chunk in enumerate(read_dataframe(infile, chunksize)):
+            print(f"\nWorking on chunk {i}\n-----------------------------------")
+            if mask is not None:
+                merger.add(chunk[mask[row:row + len(chunk)]])
+            else:
+                merger.add(sample_dataframe(chunk, percentage=self.percentage))
+            row += len(chunk)
+        return merger.result()
+
+    def _stream_split(self, merger_large, merger_small):
+        """Splits the input file range by range, assigning every row by the
+        hash of its id. The assignment of a row doesn't depend on any other
+        row, so the split is reproducible for a seed and needs no first pass.
+        """
+        infile = self._get_stream_input()
+        if os.path.splitext(infile)[1] in COMPRESSED_EXTENSIONS:
+            chunksize = self.chunksize or BINARY_DATASET_CHUNKSIZE
+            print(f"\nStart split in chunks with size {chunksize} rows")
+            for i, chunk in enumerate(read_dataframe(infile, chunksize)):
+                print(f"\nWorking on chunk {i}\n-----------------------------------")
+                mask = split_mask(chunk['id'], self.percentage, seed=self.split_seed)
+                merger_large.add(chunk[mask])
+                merger_small.add(chunk[~mask])
+            return merger_large.result(), merger_small.result()
+
+        nr_features = _get_nr_features(infile)
+        tasks = [(infile, start, end, nr_features, self.percentage, self.split_seed)
+                 for start, end in self._get_ranges(infile)]
+        print(f"\nStart split on {len(tasks)} ranges with {self.nr_cores} cores")
+        for i, (result_large, result_small, packed, nr_features) in enumerate(self._map(_split_rows, tasks)):
+            print(f"\nCombining range {i}\n-----------------------------------")
+            merger_large.add_fingerprints(*fetch_fingerprints(result_large), packed=packed, nr_features=nr_features)
+            merger_small.add_fingerprints(*fetch_fingerprints(result_small), packed=packed, nr_features=nr_features)
+        return merger_large.result(), merger_small.result()
+
+    def _get_merger(self, outfile=None, shuffle=True):
+        return ResultMerger(outfile, shuffle=shuffle, memory_budget=self.memory_budget)
+
+    def _get_stream_input(self):
+        if self.cache is not None and not is_binary_dataset(self.infile):
+            return self.cache.fetch(self.infile) or self.infile
+        return self.infile
+
+    def _get_mask(self, submode, labels):
+        if submode == 'balancing':
+            return balancing_mask(labels, percentage=self.percentage)
+        elif submode == 'trim':
+            return trim_mask(len(labels), percentage=self.percentage, shuffle=self.shuffle)
+        else:
+            raise ModeError(self.mode, submode)
+
+    def _map(self, func, tasks, ordered=True):
+        """Maps func over tasks with the worker pool, or in this process when running on one core."""
+        if self.nr_cores == 1:
+            return map(func, tasks)
+        elif ordered:
+            return self._get_pool().imap(func, tasks)
+        else:
+            return self._get_pool().imap_unordered(func, tasks)
+
+    def _get_ranges(self, infile):
+        """Splits the input into the (start, end) ranges handled by one worker
+        task each: byte ranges of whole lines for text files, row ranges for
+        binary datasets.
+        """
+        if is_binary_dataset(infile):
+            nr_rows = len(BinaryDataset(infile))
+            nr_ranges = max(self.nr_cores, -(-nr_rows // (self.chunksize or BINARY_DATASET_CHUNKSIZE)))
+            boundaries = np.linspace(0, nr_rows, nr_ranges + 1).astype(int)
+            return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+        nr_ranges = max(self.nr_cores, -(-os.path.getsize(infile) // self.plan.block_size))
+        return get_byte_ranges(infile, nr_ranges)
+
+    def _get_pool(self):
+        """Returns the worker pool, which is started once and reused by every
+        multicore stage until close_pool is called.
+        """
+        if self._pool is None:
+            import multiprocessing as mp
+            self._pool = mp.get_context('spawn').Pool(self.nr_cores)
+        return self._pool
+
+    def close_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
     def balancing(self, dataframes=None):
         try:
@@ -117,11 +350,11 @@ class AIchemyPreProc(object, metaclass=ABCMeta):
     def sample(self, dataframes=None):
         return self._sample_or_balancing('sample', dataframes)
 
-    def _sample_or_balancing(self, submode, dataframes=None):
+    def _sample_or_balancing(self, submode, dataframes=None, merger=None):
         if submode == 'balancing' or submode == 'sample':
             if dataframes is None:
                 infile = self.infile
-                dataframes = read_dataframe(infile, chunksize=self.chunksize)
+                dataframes = read_dataframe(infile, chunksize=self.chunksize, cache=self.cache)
 
             if self.nr_cores == 1:
                 print1 = f"\nStart {submode} dataframe"
@@ -131,8 +364,9 @@ class AIchemyPreProc(object, metaclass=ABCMeta):
                     print2 = ""
                 print(print1 + print2)
 
-            dataframe_results = pd.DataFrame()
-            if self.nr_cores == 1 and isinstance(dataframes, Chunks):
+            if self.nr_cores == 1 and isinstance(dataframes, CHUNK_READERS):
+                if merger is None:
+                    merger = ResultMerger()
                 for i, chunk in enumerate(dataframes):
                     print(f"\nWorking on chunk {i}\n-----------------------------------")
                     if submode == 'balancing':
@@ -142,7 +376,8 @@ class AIchemyPreProc(object, metaclass=ABCMeta):
                     else:
                         raise ModeError(self.mode, submode)
 
-                    dataframe_results = pd.concat([dataframe_results, dataframe_chunk])
+                    merger.add(dataframe_chunk)
+                return merger.result()
 
             elif (self.nr_cores > 1) or isinstance(dataframes, pd.DataFrame):
                 if submode == 'balancing':
@@ -169,9 +404,10 @@ class AIchemyPreProc(object, metaclass=ABCMeta):
         return self._split_or_trim('trim', dataframe, index)
 
     def _split_or_trim(self, submode, dataframe=None, index=None):
-        if submode == 'split' or submode != 'trim':
+        if submode == 'split' or submode == 'trim':
             if dataframe is None:
-                dataframe = read_dataframe(self.infile, shuffle=self.shuffle)
+                dataframe = read_dataframe(self.infile, shuffle=self.shuffle, nr_cores=self.nr_cores,
+                                           cache=self.cache)
 
             if index is None:
                 if submode == 'split':
@@ -194,15 +430,22 @@ class PreProcNormal(AIchemyPreProc):
     def __init__(self, controller):
         super(PreProcNormal, self).__init__(controller)
         self.submode = controller.args.preproc_mode
+        self.sparse = controller.args.sparse
 
     def run(self):
-        if self.nr_cores > 1:
-            if self.submode in MULTICORE_SUPPORT:
-                self._multicore(self.submode)
+        with self.planner.track(self.plan):
+            if self.sparse:
+                self._sparse(self.submode)
+            elif self.nr_cores > 1:
+                if self.submode in MULTICORE_SUPPORT:
+                    try:
+                        self._multicore(self.submode)
+                    finally:
+                        self.close_pool()
+                else:
+                    raise NoMultiCoreSupportError(self.submode)
             else:
-                raise NoMultiCoreSupportError(self.submode)
-        else:
-            self._single_core(self.submode)
+                self._single_core(self.submode)
 
 
 class PreProcAuto(AIchemyPreProc):
@@ -214,8 +457,36 @@ class PreProcAuto(AIchemyPreProc):
         self.auto_save_preproc = controller.config.execute.auto_save_preproc
         self.auto_plus_balancing = (self.mode == 'auto' and controller.config.execute.auto_plus_balancing)
         self.auto_plus_sample = (self.mode == 'auto' and controller.config.execute.auto_plus_sample)
+        if self.mode == 'auto':
+            streaming_split_size = controller.config.execute.streaming_split_size * 2 ** 30
+            self.streaming = get_dataset_size(self.infile) >= streaming_split_size or not self.plan.fits
+        self.save_thread = None
+        self._save_error = None
 
     def run(self):
+        with self.planner.track(self.plan):
+            return self._run()
+
+    def _run(self):
+        try:
+            if self.streaming:
+                data = self._run_streaming()
+            else:
+                # The input is read once, balancing, sample and split only select rows of it.
+                pool = self._get_pool() if self.nr_cores > 1 else None
+                dataset = AIchemyDataset.from_file(self.infile, nr_cores=self.nr_cores, cache=self.cache, pool=pool)
+                if self.auto_plus_balancing:
+                    print("\nStart balancing on dataset")
+                    dataset = dataset.balance(self.balancing_ratio)
+                if self.auto_plus_sample:
+                    print("\nStart sample on dataset")
+                    dataset = dataset.sample(self.sample_ratio)
+                data = self._run_auto_mode('split', dataset, save=self.auto_save_preproc)
+        finally:
+            self.close_pool()
+        return data
+
+    def _run_streaming(self):
         if self.auto_plus_balancing and self.auto_plus_sample:
             dataframe = self._run_auto_mode('balancing', save=False)
             dataframe = self._run_auto_mode('sample', dataframe, save=False)
@@ -226,26 +497,31 @@ class PreProcAuto(AIchemyPreProc):
         else:
             dataframe = None
 
-        data = self._run_auto_mode('split', dataframe, save=self.auto_save_preproc)
-        return data
+        if dataframe is not None:
+            dataframe = AIchemyDataset.from_dataframe(dataframe)
+        return self._run_auto_mode('split', dataframe, save=self.auto_save_preproc)
 
     def _run_auto_mode(self, submode, dataframe=None, save=True):
         if submode == 'split':
             train_file_path = self._make_auto_outfile('train')
             test_file_path = self._make_auto_outfile('test')
             self.percentage = self.train_test_ratio
-            if save:
-                self._single_core(submode, dataframe, outfile=train_file_path, outfile2=test_file_path)
-                self.percentage = None
-                return {'train': train_file_path, 'test': test_file_path}
+            if dataframe is None and self.streaming:
+                # Inputs this large are split on disk, the models read the files back in.
+                self._single_core(submode, outfile=train_file_path, outfile2=test_file_path)
+                data = {'train': train_file_path, 'test': test_file_path}
             else:
-                # Todo: Fix bug with piping of dataframe to models
-                raise NotImplementedError("'Not saving preproc results' not yet implemented")
-                """
-                train_dataframe, test_dataframe = self._single_core(submode, dataframe, save=False)
-                self.percentage = None
-                return {'train': train_dataframe, 'test': test_dataframe}
-                """
+                # The train and test datasets are views of the same rows and are handed to the models as they are,
+                #  while saving them runs in the background.
+                train_dataset, test_dataset = self._single_core(submode, dataframe, save=False)
+                data = {'train': train_dataset, 'test': test_dataset}
+                if save:
+                    self.save_thread = threading.Thread(target=self._save_split,
+                                                        args=(train_dataset, test_dataset,
+                                                              train_file_path, test_file_path))
+                    self.save_thread.start()
+            self.percentage = None
+            return data
 
         elif submode == 'sample' or submode == 'balancing':
             if submode == 'sample':
@@ -268,6 +544,24 @@ class PreProcAuto(AIchemyPreProc):
         else:
             raise ModeError(self.mode, submode)
 
+    def _save_split(self, train_dataset, test_dataset, train_file_path, test_file_path):
+        try:
+            train_dataset.save(train_file_path)
+            test_dataset.save(test_file_path)
+        except Exception as e:
+            self._save_error = e
+
+    def wait_for_save(self):
+        """Waits until the background saving of the split has finished and
+        raises its error, if any.
+        """
+        if self.save_thread is not None:
+            self.save_thread.join()
+            self.save_thread = None
+        if self._save_error is not None:
+            error, self._save_error = self._save_error, None
+            raise error
+
     def _make_auto_outfile(self, suffix, file=None):
         if file is None:
             file = self.infile
@@ -277,26 +571,71 @@ class PreProcAuto(AIchemyPreProc):
         return f"{self.src_dir}/data/{self.name}/{file_name}_{suffix}{file_extension}"
 
 
-# Todo: Make the amount of classes dynamic
-def balancing_dataframe(dataframe, percentage=1):
-    dataframe_class0 = dataframe[dataframe['class'] == 0]
-    dataframe_class1 = dataframe[dataframe['class'] == 1]
+def _read_range(infile, start, end, nr_features):
+    """Reads the rows of one byte range of a text file, or row range of a
+    binary dataset. Returns the ids, classes and features, whether the
+    features are bit-packed and the number of features.
+    """
+    if is_binary_dataset(infile):
+        dataset = BinaryDataset(infile)
+        return dataset.ids[start:end], dataset.labels[start:end], dataset.features[start:end], True, \
+            dataset.nr_features
+
+    ids, labels, features, packed = parse_fingerprint_range(infile, start, end, packed=True, nr_features=nr_features)
+    return ids, labels, features, packed, nr_features if packed else features.shape[1]
+
+
+def _get_nr_features(infile):
+    if is_binary_dataset(infile):
+        return None
+    with open(infile, 'rb') as fin:
+        return len(fin.readline().split()) - 2
+
+
+def _select_rows(task):
+    """Worker task of the streaming balancing, sample and trim. Reads and
+    parses its own range, selects the rows and hands them back through shared
+    memory. The selection is either the mask of rows to keep or the
+    percentage to sample. Returns the shared memory descriptor, whether the
+    features are bit-packed and the number of features.
+    """
+    infile, start, end, nr_features, selection = task
+    ids, labels, features, packed, nr_features = _read_range(infile, start, end, nr_features)
+
+    if isinstance(selection, np.ndarray):
+        if len(selection) != len(labels):
+            error_message = f"Expected {len(selection)} rows in range {start}-{end} of {infile} but got {len(labels)}"
+            raise ValueError(error_message)
+        indices = np.flatnonzero(selection)
+    else:
+        indices = np.sort(sample_indices(len(labels), percentage=selection))
 
-    dataframe_class1_sampled = sample_dataframe(dataframe_class1, 1)
+    return share_fingerprints(ids[indices], labels[indices], features[indices]), packed, nr_features
 
-    data_div = dataframe_class1_sampled['class'].value_counts()
-    nr_samples = int(np.round(data_div[1]*percentage, decimals=0))
 
-    if nr_samples > 1:
-        dataframe_class0_balancing = resample(dataframe_class0,
-                                              replace=False,
-                                              n_samples=nr_samples,
-                                              random_state=randrange(100, 999))
+def _split_rows(task):
+    """Worker task of the streaming split, returning both parts of its range
+    through shared memory.
+    """
+    infile, start, end, nr_features, percentage, seed = task
+    ids, labels, features, packed, nr_features = _read_range(infile, start, end, nr_features)
+    mask = split_mask(ids, percentage, seed=seed)
+    return share_fingerprints(ids[mask], labels[mask], features[mask]), \
+        share_fingerprints(ids[~mask], labels[~mask], features[~mask]), packed, nr_features
 
-        return pd.concat([dataframe_class0_balancing, dataframe_class1_sampled])
 
-    else:
+def _read_labels(task):
+    infile, start, end = task
+    if is_binary_dataset(infile):
+        return np.array(BinaryDataset(infile).labels[start:end])
+    return parse_labels(read_byte_range(infile, start, end))
+
+
+def balancing_dataframe(dataframe, percentage=1):
+    indices = balancing_indices(dataframe['class'].to_numpy(), percentage=percentage)
+    if len(indices) == 0:
         return pd.DataFrame()
+    return dataframe.iloc[indices]
 
 
 def sample_dataframe(dataframe, percentage=1):
@@ -1,6 +1,10 @@
+import io
+import json
 import os
 import re
+import shutil
 import sys
+import tempfile
 import time
 
 import numpy as np
@@ -8,6 +12,28 @@ import pandas as pd
 from random import randrange
 from functools import wraps
 
+_NEWLINE = ord('\n')
+_CARRIAGE_RETURN = ord('\r')
+_SPACE = ord(' ')
+_TAB = ord('\t')
+_ZERO = ord('0')
+
+ID_ENCODING = 'utf-8'
+
+BINARY_DATASET_EXTENSION = '.aichemy'
+BINARY_DATASET_VERSION = 1
+BINARY_DATASET_META = 'meta.json'
+BINARY_DATASET_IDS = 'ids.bin'
+BINARY_DATASET_LABELS = 'labels.bin'
+BINARY_DATASET_FEATURES = 'features.bin'
+BINARY_DATASET_CHUNKSIZE = 100000
+PARALLEL_READ_MIN_SIZE = 2 ** 24
+PARSE_BLOCK_SIZE = 2 ** 26
+PARSE_ROW_BLOCK = 2 ** 14
+COMPRESSED_EXTENSIONS = ['.bz2', '.gz', '.xz', '.zip']
+SHUFFLE_MEMORY_FACTOR = 2
+MAX_SHUFFLE_BUCKETS = 1000
+
 
 class Timer(object):
     def __init__(self, func, verbose=0):
@@ -191,34 +217,47 @@ def read_parameters(infile, params_dict):
             params_dict[items[0]] = items[1]
 
 
-def read_array(infile, data_type):
+def read_array(infile, data_type, nr_cores=1, cache=None):
     """Reads a white space separated file without a header.
     The first column contains the IDs of samples and the 2nd the class.
     All the following columns contain features (the independent variables)
     of the sample. The function first determines the size of the arrays to
-    be created, then inserts data into them.
+    be created, then inserts data into them. Uncompressed files are parsed
+    in byte ranges, which are spread over a process pool for large files.
     """
+    if cache is not None and not is_binary_dataset(infile):
+        infile = cache.fetch(infile) or infile
+
     print(f"Reading from '{infile}'.")
 
-    # read (compressed) features
-    file_name, extension = os.path.splitext(infile)
-    if extension == ".bz2":
-        import bz2
-        f = bz2.open(infile, 'rb')
-    elif extension == ".gz":
-        import gzip
-        f = gzip.open(infile, 'rb')
-    else:
-        f = open(infile, 'r')
+    if is_binary_dataset(infile):
+        id, data = BinaryDataset(infile).to_array(data_type)
+        print(f"Read {len(id)} samples in total.\n")
+        return id, data
+
+    if os.path.splitext(infile)[1] not in COMPRESSED_EXTENSIONS:
+        if not supports_parallel_read(infile):
+            nr_cores = 1
+        id, data = _read_array_ranges(infile, data_type, nr_cores)
+        print(f"Read {len(id)} samples in total.\n")
+        return id, data
 
-    nrow = sum(1 for _ in f)
+    # read (compressed) features
+    f = open_file(infile)
+
+    # The first pass also finds the widest id, so the ids can be stored as fixed-width bytes.
+    nrow = 0
+    id_width = 1
+    for line in f:
+        nrow += 1
+        id_width = max(id_width, len(line.split(None, 1)[0]))
     f.seek(0)
     ncol = len(f.readline().split()) - 1  # Disregarding ID column.
     f.seek(0)
     # Initializing arrays.
     print(f"Initializing array of size {nrow} X {ncol}.")
-    id = np.empty(nrow, dtype=np.dtype('U50'))
-    print(f"Memory of ID_array(str): {(id.nbytes * 10 ** (-6))} MB.")
+    id = np.empty(nrow, dtype=np.dtype(f"S{id_width}"))
+    print(f"Memory of ID_array(bytes): {(id.nbytes * 10 ** (-6))} MB.")
     if data_type == 'integer':
         data = np.empty((nrow, ncol), dtype=int)
     if data_type == 'float':
@@ -226,8 +265,6 @@ def read_array(infile, data_type):
     print(f"Memory of data_array: {(data.nbytes * 10 ** (-6))} MB.")
 
     for i, line in enumerate(f):
-        if extension == ".bz2" or extension == ".gz":
-            line = line.decode()
         sample_id, sample_data = line.strip().split(None, 1)
         id[i] = sample_id
         data[i] = sample_data.split()
@@ -240,10 +277,23 @@ def read_array(infile, data_type):
     return id, data
 
 
-def read_dataframe(infile, chunksize=None, shuffle=False):
+def read_dataframe(infile, chunksize=None, shuffle=False, nr_cores=1, cache=None, pool=None):
+    if cache is not None and not is_binary_dataset(infile):
+        infile = cache.fetch(infile) or infile
+
+    if is_binary_dataset(infile):
+        dataset = BinaryDataset(infile)
+        if chunksize:
+            return dataset.iter_dataframes(chunksize)
+        else:
+            dataframe = dataset.to_dataframe()
+            if shuffle:
+                dataframe = shuffle_dataframe(dataframe)
+            return dataframe
+
     print("\nReading from {file}".format(file=infile))
 
-    with open(infile) as fin:
+    with open_file(infile, 'rt') as fin:
         first_line = next(fin)
         line_data = re.split(" |\t|[|]", first_line)
         num_cols = len(line_data)
@@ -255,9 +305,17 @@ def read_dataframe(infile, chunksize=None, shuffle=False):
     for i in range(1, (num_cols - 1)):
         columns_types[str(i)] = 'int8'
 
-    if chunksize:
+    if not chunksize and os.path.splitext(infile)[1] not in COMPRESSED_EXTENSIONS:
+        if not supports_parallel_read(infile):
+            nr_cores = 1
+        dataframe = _read_dataframe_ranges(infile, columns_names, nr_cores, pool)
+
+        if shuffle:
+            dataframe = shuffle_dataframe(dataframe)
+
+    elif chunksize:
         dataframe = pd.read_csv(infile,
-                                sep='\s+',
+                                sep=r'\s+',
                                 skip_blank_lines=True,
                                 header=None,
                                 names=columns_names,
@@ -268,7 +326,7 @@ def read_dataframe(infile, chunksize=None, shuffle=False):
 
     else:
         dataframe = pd.read_csv(infile,
-                                sep='\s+',
+                                sep=r'\s+',
                                 skip_blank_lines=True,
                                 header=None,
                                 names=columns_names,
@@ -281,7 +339,501 @@ def read_dataframe(infile, chunksize=None, shuffle=False):
     return dataframe
 
 
+def open_file(infile, mode='rb', fileobj=None):
+    """Opens a file for reading, decompressing it according to its extension.
+    An already opened fileobj of infile is read instead of opening it again.
+    """
+    extension = os.path.splitext(infile)[1]
+    if extension == ".bz2":
+        import bz2
+        return bz2.open(fileobj or infile, mode)
+    elif extension == ".gz":
+        import gzip
+        return gzip.open(fileobj or infile, mode)
+    elif extension == ".xz":
+        import lzma
+        return lzma.open(fileobj or infile, mode)
+    elif fileobj is not None:
+        return io.TextIOWrapper(fileobj) if 't' in mode else fileobj
+    else:
+        return open(infile, mode)
+
+
+def compact_ids(ids):
+    """Stores sample ids as one fixed-width bytes array, sized to the
+    longest id, instead of as one Python string object per sample.
+    """
+    ids = np.asarray(ids)
+    if ids.dtype.kind == 'S':
+        return ids
+    if ids.size == 0:
+        return np.empty(0, dtype='S1')
+    return np.char.encode(ids.astype(str), ID_ENCODING)
+
+
+def decode_ids(ids):
+    """Returns compact ids as strings, e.g. for writing them to text files."""
+    ids = np.asarray(ids)
+    if ids.dtype.kind == 'S':
+        return np.char.decode(ids, ID_ENCODING)
+    return ids.astype(str)
+
+
+def supports_parallel_read(infile):
+    """Byte ranges can only be read from uncompressed files, and for small
+    files the process pool costs more than it saves.
+    """
+    extension = os.path.splitext(infile)[1]
+    return extension not in COMPRESSED_EXTENSIONS and os.path.getsize(infile) >= PARALLEL_READ_MIN_SIZE
+
+
+def get_byte_ranges(infile, nr_ranges):
+    """Splits a file into at most nr_ranges (start, end) byte ranges. Every
+    boundary is moved forward to the start of the next line, so each range
+    holds whole lines only.
+    """
+    size = os.path.getsize(infile)
+    boundaries = [0]
+    with open(infile, 'rb') as fin:
+        for i in range(1, nr_ranges):
+            fin.seek(max(size * i // nr_ranges, boundaries[-1]))
+            fin.readline()
+            boundaries.append(min(fin.tell(), size))
+    boundaries.append(size)
+
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+def read_byte_range(infile, start, end):
+    with open(infile, 'rb') as fin:
+        fin.seek(start)
+        return fin.read(end - start)
+
+
+def parse_fingerprints(buffer, packed=False):
+    """Parses a buffer of whole lines laid out as an id, a single digit class
+    and single character 0/1 features, all separated by one space or tab.
+    The features are read straight from the raw bytes through a strided
+    window view, without tokenizing. Returns the ids (fixed-width bytes), the
+    classes (int8) and the features (0/1 uint8, or bit-packed), or None if
+    the buffer doesn't follow the layout.
+    """
+    data, line_starts, line_ends = _split_lines(buffer)
+    if line_starts.size == 0:
+        return None
+
+    first_line = bytes(data[line_starts[0]:line_ends[0]]).split()
+    nr_features = len(first_line) - 2
+    if nr_features < 1 or any(len(token) != 1 for token in first_line[2:]):
+        return None
+
+    tail_width = 2 * nr_features - 1
+    tail_starts = line_ends - tail_width
+    if (tail_starts - line_starts < 4).any() or not _is_separator(data[tail_starts - 1]).all():
+        return None
+
+    nr_rows = len(line_starts)
+    tails = np.lib.stride_tricks.sliding_window_view(data, tail_width)
+    if packed:
+        features = np.empty((nr_rows, (nr_features + 7) // 8), dtype=np.uint8)
+    else:
+        features = np.empty((nr_rows, nr_features), dtype=np.uint8)
+
+    for block_start in range(0, nr_rows, PARSE_ROW_BLOCK):
+        block = slice(block_start, block_start + PARSE_ROW_BLOCK)
+        block_tails = tails[tail_starts[block]]
+        # Characters other than '0' and '1' wrap around to values above 1.
+        bits = block_tails[:, ::2] - np.uint8(_ZERO)
+        if (bits > 1).any() or not _is_separator(block_tails[:, 1::2]).all():
+            return None
+        if packed:
+            features[block] = np.packbits(bits, axis=1)
+        else:
+            features[block] = bits
+
+    class_chars = data[tail_starts - 2]
+    id_ends = tail_starts - 3
+    if ((class_chars - np.uint8(_ZERO) <= 9).all() and _is_separator(data[id_ends]).all()
+            and not _is_separator(data[line_starts]).any()):
+        labels = (class_chars - np.uint8(_ZERO)).astype(np.int8)
+        ids = _gather_ids(data, line_starts, id_ends - line_starts)
+    else:
+        heads = [bytes(data[start:end]).split() for start, end in zip(line_starts, tail_starts - 1)]
+        if any(len(head) != 2 for head in heads):
+            return None
+        try:
+            labels = np.array([int(head[1]) for head in heads], dtype=np.int8)
+        except ValueError:
+            return None
+        ids = np.array([head[0] for head in heads], dtype=bytes)
+
+    return ids, labels, features
+
+
+def parse_labels(buffer):
+    """Parses only the classes from a buffer of whole lines, i.e. the second
+    white space separated token of every non blank line, as int8.
+    """
+    data, line_starts, line_ends = _split_lines(buffer)
+    if line_starts.size == 0:
+        return np.empty(0, dtype=np.int8)
+
+    # Every line ends with a newline, which serves as the separator after the class of featureless rows.
+    separators = np.flatnonzero(_is_separator(data) | (data == _NEWLINE) | (data == _CARRIAGE_RETURN))
+    first = np.searchsorted(separators, line_starts)
+    class_starts = separators[first] + 1
+    class_ends = separators[np.minimum(first + 1, separators.size - 1)]
+    class_chars = data[np.minimum(class_starts, data.size - 1)]
+    if ((class_ends - class_starts == 1).all() and (class_starts < line_ends).all()
+            and (class_chars - np.uint8(_ZERO) <= 9).all() and not _is_separator(data[line_starts]).any()):
+        return (class_chars - np.uint8(_ZERO)).astype(np.int8)
+
+    return np.array([int(bytes(data[start:end]).split()[1]) for start, end in zip(line_starts, line_ends)],
+                    dtype=np.int8)
+
+
+def _split_lines(buffer):
+    """Returns the bytes of a buffer, ending with a newline, and the start
+    and end offsets of its non blank lines. The ends leave out the newline
+    and a carriage return before it.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size and data[-1] != _NEWLINE:
+        data = np.append(data, np.uint8(_NEWLINE))
+
+    line_ends = np.flatnonzero(data == _NEWLINE)
+    line_starts = np.empty_like(line_ends)
+    line_starts[:1] = 0
+    line_starts[1:] = line_ends[:-1] + 1
+    line_ends = line_ends - (data[line_ends - 1] == _CARRIAGE_RETURN)
+    non_blank = line_ends > line_starts
+    return data, line_starts[non_blank], line_ends[non_blank]
+
+
+def _is_separator(chars):
+    return (chars == _SPACE) | (chars == _TAB)
+
+
+def _gather_ids(data, starts, lengths):
+    """Copies the variable length ids into one fixed-width bytes array."""
+    width = max(int(lengths.max()), 1)
+    if starts[-1] + width > data.size:
+        data = np.concatenate([data, np.zeros(width, dtype=np.uint8)])
+    ids = np.lib.stride_tricks.sliding_window_view(data, width)[starts]
+    ids[np.arange(width) >= lengths[:, None]] = 0
+    return ids.view(f"S{width}").ravel()
+
+
+def fingerprints_to_dataframe(ids, labels, features):
+    """Builds a dataframe with the same layout and types as read_dataframe."""
+    columns_names = [str(i) for i in range(1, features.shape[1] + 1)]
+    dataframe = pd.DataFrame(features.view(np.int8), columns=columns_names, copy=False)
+    dataframe.insert(0, 'class', labels)
+    dataframe.insert(0, 'id', pd.array(decode_ids(ids), dtype='string'))
+    return dataframe
+
+
+def parse_fingerprint_range(infile, start, end, packed=False, nr_features=None, dtype=np.uint8):
+    """Parses the rows of one byte range of a text file. Rows in the layout
+    of parse_fingerprints take its fast path, bit-packed with packed, other
+    rows are read with read_csv and their features converted to dtype. With
+    nr_features a fast path result of another width is read with read_csv
+    as well. Returns the ids, the classes, the features and whether they are
+    bit-packed, which the read_csv features never are.
+    """
+    buffer = read_byte_range(infile, start, end)
+    fingerprints = parse_fingerprints(buffer, packed=packed)
+    if fingerprints is not None:
+        width = fingerprints[2].shape[1]
+        if nr_features is None or width == ((nr_features + 7) // 8 if packed else nr_features):
+            return fingerprints + (packed,)
+
+    dataframe = pd.read_csv(io.BytesIO(buffer), sep=r'\s+', skip_blank_lines=True, header=None,
+                            dtype={0: str}, engine='c')
+    return (compact_ids(dataframe.iloc[:, 0]),
+            dataframe.iloc[:, 1].to_numpy(dtype=np.int8),
+            dataframe.iloc[:, 2:].to_numpy(dtype=dtype),
+            False)
+
+
+def _parse_dataframe_range(task):
+    infile, start, end, columns_names = task
+    ids, labels, features, _ = parse_fingerprint_range(infile, start, end, nr_features=len(columns_names) - 2)
+    return fingerprints_to_dataframe(ids, labels, features)
+
+
+def _parse_array_range(task):
+    infile, start, end, data_type = task
+    if data_type == 'integer':
+        dtype = int
+    else:
+        dtype = float
+
+    ids, labels, features, _ = parse_fingerprint_range(infile, start, end, dtype=dtype)
+    data = np.empty((len(ids), features.shape[1] + 1), dtype=dtype)
+    data[:, 0] = labels
+    data[:, 1:] = features
+    return ids, data
+
+
+def _map_byte_ranges(parser, tasks, nr_cores):
+    import multiprocessing as mp
+
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(min(nr_cores, len(tasks))) as pool:
+        # map keeps the results in the order of the byte ranges, i.e. the original row order.
+        results = pool.map(parser, tasks)
+        pool.close()
+        pool.join()
+    return results
+
+
+def _get_parse_ranges(infile, nr_cores):
+    nr_blocks = -(-os.path.getsize(infile) // PARSE_BLOCK_SIZE)
+    byte_ranges = get_byte_ranges(infile, max(nr_cores, nr_blocks))
+    if nr_cores > 1:
+        print(f"Reading {len(byte_ranges)} byte ranges with {nr_cores} cores")
+    return byte_ranges
+
+
+def _parse_ranges(parser, tasks, nr_cores, pool=None):
+    if nr_cores > 1 and pool is not None:
+        return pool.map(parser, tasks)
+    elif nr_cores > 1:
+        return _map_byte_ranges(parser, tasks, nr_cores)
+    else:
+        return [parser(task) for task in tasks]
+
+
+def _read_dataframe_ranges(infile, columns_names, nr_cores, pool=None):
+    byte_ranges = _get_parse_ranges(infile, nr_cores)
+    tasks = [(infile, start, end, columns_names) for start, end in byte_ranges]
+    dataframes = _parse_ranges(_parse_dataframe_range, tasks, nr_cores, pool)
+    if len(dataframes) == 1:
+        return dataframes[0]
+    return pd.concat(dataframes, ignore_index=True, copy=False)
+
+
+def _read_array_ranges(infile, data_type, nr_cores):
+    byte_ranges = _get_parse_ranges(infile, nr_cores)
+    tasks = [(infile, start, end, data_type) for start, end in byte_ranges]
+    results = _parse_ranges(_parse_array_range, tasks, nr_cores)
+
+    nrow = sum(len(range_id) for range_id, _ in results)
+    ncol = results[0][1].shape[1]
+    id_width = max(range_id.dtype.itemsize for range_id, _ in results)
+    print(f"Initializing array of size {nrow} X {ncol}.")
+    id = np.empty(nrow, dtype=np.dtype(f"S{id_width}"))
+    print(f"Memory of ID_array(bytes): {(id.nbytes * 10 ** (-6))} MB.")
+    data = np.empty((nrow, ncol), dtype=results[0][1].dtype)
+    print(f"Memory of data_array: {(data.nbytes * 10 ** (-6))} MB.")
+
+    row = 0
+    while results:
+        # Releasing each range as soon as it has been copied keeps the peak at one extra range.
+        range_id, range_data = results.pop(0)
+        id[row:row + len(range_id)] = range_id
+        data[row:row + len(range_id)] = range_data
+        row += len(range_id)
+
+    return id, data
+
+
+def share_fingerprints(ids, labels, features):
+    """Copies a block of rows into one shared memory segment and returns a
+    small picklable descriptor of it, so workers can hand their results back
+    without pickling the arrays.
+    """
+    from multiprocessing import shared_memory
+
+    ids = compact_ids(ids)
+    labels = np.asarray(labels, dtype=np.int8)
+    features = np.ascontiguousarray(features, dtype=np.uint8)
+    segment = shared_memory.SharedMemory(create=True, size=max(ids.nbytes + labels.nbytes + features.nbytes, 1))
+    offset = 0
+    for array in (ids, labels, features):
+        np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf, offset=offset)[...] = array
+        offset += array.nbytes
+    segment.close()
+    return segment.name, len(ids), ids.dtype.itemsize, features.shape[1]
+
+
+def fetch_fingerprints(descriptor):
+    """Copies the rows of a share_fingerprints descriptor out of shared
+    memory and frees the segment.
+    """
+    from multiprocessing import shared_memory
+
+    name, nr_rows, id_width, nr_columns = descriptor
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        ids = np.ndarray((nr_rows,), dtype=f"S{id_width}", buffer=segment.buf).copy()
+        offset = ids.nbytes
+        labels = np.ndarray((nr_rows,), dtype=np.int8, buffer=segment.buf, offset=offset).copy()
+        offset += labels.nbytes
+        features = np.ndarray((nr_rows, nr_columns), dtype=np.uint8, buffer=segment.buf, offset=offset).copy()
+    finally:
+        segment.close()
+        segment.unlink()
+    return ids, labels, features
+
+
+def share_arrays(arrays):
+    """Copies a dict of arrays into one shared memory segment, so several
+    workers can read them without a copy each. Returns the segment, which
+    the caller unlinks once the workers are done, and a small picklable
+    descriptor the workers pass to attach_arrays.
+    """
+    from multiprocessing import shared_memory
+
+    arrays = {key: np.ascontiguousarray(array) for key, array in arrays.items()}
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+        layout.append((key, array.shape, array.dtype.str, offset))
+        # Every array starts 8 byte aligned.
+        offset += -(-array.nbytes // 8) * 8
+    segment = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for key, shape, dtype, offset in layout:
+        np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=offset)[...] = arrays[key]
+    return segment, (segment.name, layout)
+
+
+def attach_arrays(descriptor):
+    """Returns the segment of a share_arrays descriptor and views of its
+    arrays. The views have to be dropped before the segment is closed.
+    """
+    from multiprocessing import shared_memory
+
+    name, layout = descriptor
+    segment = shared_memory.SharedMemory(name=name)
+    arrays = {key: np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=offset)
+              for key, shape, dtype, offset in layout}
+    return segment, arrays
+
+
+def read_sparse(infile, nr_cores=1, cache=None):
+    """Reads a dataset with the features as a scipy.sparse CSR matrix. The
+    file is parsed in blocks that are converted to CSR one at a time, so the
+    dense features are never held in memory all at once.
+    """
+    from scipy import sparse
+
+    if cache is not None and not is_binary_dataset(infile):
+        infile = cache.fetch(infile) or infile
+
+    print(f"\nReading sparse features from {infile}")
+    if is_binary_dataset(infile):
+        dataset = BinaryDataset(infile)
+        blocks = [(dataset.ids[start:start + BINARY_DATASET_CHUNKSIZE],
+                   dataset.labels[start:start + BINARY_DATASET_CHUNKSIZE],
+                   sparse.csr_matrix(dataset.unpack(start, start + BINARY_DATASET_CHUNKSIZE)))
+                  for start in range(0, len(dataset), BINARY_DATASET_CHUNKSIZE)]
+
+    elif os.path.splitext(infile)[1] in COMPRESSED_EXTENSIONS:
+        blocks = [(compact_ids(chunk['id']),
+                   chunk['class'].to_numpy(dtype=np.int8),
+                   sparse.csr_matrix(chunk.iloc[:, 2:].to_numpy(dtype=np.uint8)))
+                  for chunk in read_dataframe(infile, chunksize=BINARY_DATASET_CHUNKSIZE)]
+
+    else:
+        if not supports_parallel_read(infile):
+            nr_cores = 1
+        tasks = [(infile, start, end, False, None) for start, end in _get_parse_ranges(infile, nr_cores)]
+        blocks = _parse_ranges(_parse_sparse_range, tasks, nr_cores)
+
+    ids = np.concatenate([compact_ids(block_ids) for block_ids, _, _ in blocks])
+    labels = np.concatenate([block_labels for _, block_labels, _ in blocks]).astype(np.int8)
+    features = sparse.vstack([block_features for _, _, block_features in blocks], format='csr')
+
+    density = features.nnz / max(features.shape[0] * features.shape[1], 1)
+    print(f"Read {features.shape[0]} samples with a feature density of {density:.3f}.")
+    return ids, labels, features
+
+
+def _parse_sparse_range(task):
+    from scipy import sparse
+
+    ids, labels, features = _parse_fingerprint_range(task)
+    return ids, labels, sparse.csr_matrix(features)
+
+
+def read_fingerprints(infile, nr_cores=1, cache=None, pool=None, packed=False):
+    """Reads a dataset as compact ids, int8 classes and 0/1 uint8 features,
+    without going through a dataframe. The parsed ranges are copied into
+    preallocated arrays one at a time. With packed every range is bit-packed
+    as soon as it is parsed and the number of features is returned as well.
+    """
+    if cache is not None and not is_binary_dataset(infile):
+        infile = cache.fetch(infile) or infile
+
+    print(f"\nReading from {infile}")
+    if is_binary_dataset(infile):
+        dataset = BinaryDataset(infile)
+        if packed:
+            return np.array(dataset.ids), np.array(dataset.labels), np.array(dataset.features), dataset.nr_features
+        return np.array(dataset.ids), np.array(dataset.labels), dataset.unpack()
+
+    if os.path.splitext(infile)[1] in COMPRESSED_EXTENSIONS:
+        blocks = []
+        nr_features = 0
+        for chunk in read_dataframe(infile, chunksize=BINARY_DATASET_CHUNKSIZE):
+            block_features = chunk.iloc[:, 2:].to_numpy(dtype=np.uint8)
+            nr_features = block_features.shape[1]
+            blocks.append((compact_ids(chunk['id']),
+                           chunk['class'].to_numpy(dtype=np.int8),
+                           pack_features(block_features) if packed else block_features))
+    else:
+        if not supports_parallel_read(infile):
+            nr_cores = 1
+        with open(infile, 'rb') as fin:
+            nr_features = max(len(fin.readline().split()) - 2, 0)
+        tasks = [(infile, start, end, packed, nr_features) for start, end in _get_parse_ranges(infile, nr_cores)]
+        blocks = _parse_ranges(_parse_fingerprint_range, tasks, nr_cores, pool)
+
+    nr_rows = sum(len(block_ids) for block_ids, _, _ in blocks)
+    id_width = max([block_ids.dtype.itemsize for block_ids, _, _ in blocks] + [1])
+    ids = np.empty(nr_rows, dtype=f"S{id_width}")
+    labels = np.empty(nr_rows, dtype=np.int8)
+    features = np.empty((nr_rows, (nr_features + 7) // 8 if packed else nr_features), dtype=np.uint8)
+    row = 0
+    while blocks:
+        block_ids, block_labels, block_features = blocks.pop(0)
+        ids[row:row + len(block_ids)] = block_ids
+        labels[row:row + len(block_ids)] = block_labels
+        features[row:row + len(block_ids)] = block_features
+        row += len(block_ids)
+
+    print(f"Read {nr_rows} samples in total.")
+    if packed:
+        return ids, labels, features, nr_features
+    return ids, labels, features
+
+
+def _parse_fingerprint_range(task):
+    infile, start, end, packed, nr_features = task
+    ids, labels, features, is_packed = parse_fingerprint_range(infile, start, end, packed=packed,
+                                                               nr_features=nr_features)
+    if packed and not is_packed:
+        features = pack_features(features)
+    return ids, labels, features
+
+
+def pack_features(features):
+    """Bit-packs a matrix of 0/1 features with np.packbits."""
+    features = np.asarray(features)
+    if features.size and (features.min() < 0 or features.max() > 1):
+        raise ValueError("Only 0/1 features can be bit-packed")
+    return np.packbits(features.astype(np.uint8, copy=False), axis=1)
+
+
 def save_dataframe(dataframe, outfile):
+    if os.path.splitext(outfile)[1] == BINARY_DATASET_EXTENSION:
+        print(f"\nSave dataframe as binary dataset to {outfile}")
+        with BinaryDatasetWriter(outfile) as writer:
+            writer.write_dataframe(dataframe)
+        return
+
     print(f"\nSave dataframe as csv to {outfile}")
 
     dataframe.to_csv(outfile,
@@ -290,6 +842,468 @@ def save_dataframe(dataframe, outfile):
                      sep='\t')
 
 
+def save_sparse(ids, labels, features, outfile):
+    """Saves a dataset with CSR features in the same format as save_dataframe,
+    densifying one block of rows at a time.
+    """
+    nr_rows = features.shape[0]
+    if os.path.splitext(outfile)[1] == BINARY_DATASET_EXTENSION:
+        print(f"\nSave sparse dataset as binary dataset to {outfile}")
+        with BinaryDatasetWriter(outfile) as writer:
+            for start in range(0, nr_rows, BINARY_DATASET_CHUNKSIZE):
+                stop = start + BINARY_DATASET_CHUNKSIZE
+                writer.write(ids[start:stop], labels[start:stop], features[start:stop].toarray())
+        return
+
+    print(f"\nSave sparse dataset as csv to {outfile}")
+    with open(outfile, 'wb') as fout:
+        for start in range(0, nr_rows, BINARY_DATASET_CHUNKSIZE):
+            stop = start + BINARY_DATASET_CHUNKSIZE
+            fout.write(format_fingerprints(ids[start:stop], labels[start:stop], features[start:stop].toarray()))
+
+
+def format_fingerprints(ids, labels, features):
+    """Formats rows of 0/1 features as the tab separated lines written by
+    save_dataframe, building the feature part of every line with numpy.
+    """
+    nr_rows, nr_features = features.shape
+    body = np.empty((nr_rows, 2 * nr_features), dtype=np.uint8)
+    body[:, ::2] = np.asarray(features, dtype=np.uint8) + np.uint8(_ZERO)
+    body[:, 1::2] = _TAB
+    body[:, -1] = _NEWLINE
+    prefixes = [b"%s\t%d\t" % (sample_id, label)
+                for sample_id, label in zip(compact_ids(ids).tolist(), np.asarray(labels).tolist())]
+    return b''.join(prefix + row.tobytes() for prefix, row in zip(prefixes, body))
+
+
+def get_dataset_size(path):
+    """Returns the size in bytes of a dataset file or binary dataset directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def is_binary_dataset(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, BINARY_DATASET_META))
+
+
+def convert_dataset(infile, outfile, chunksize=None):
+    """Converts a white space separated fingerprint file into the binary
+    dataset format. The file is streamed in chunks, so the conversion never
+    holds more than one chunk of parsed rows in memory.
+    """
+    if chunksize is None:
+        chunksize = BINARY_DATASET_CHUNKSIZE
+
+    print(f"\nConverting {infile} to binary dataset {outfile}")
+    with BinaryDatasetWriter(outfile) as writer:
+        if os.path.splitext(infile)[1] in COMPRESSED_EXTENSIONS:
+            for chunk in read_dataframe(infile, chunksize=chunksize):
+                writer.write_dataframe(chunk)
+        else:
+            with open(infile, 'rb') as fin:
+                nr_features = len(fin.readline().split()) - 2
+            for start, end in _get_parse_ranges(infile, 1):
+                ids, labels, features, packed = parse_fingerprint_range(infile, start, end, packed=True,
+                                                                        nr_features=nr_features)
+                writer.write(ids, labels, features, packed=packed, nr_features=nr_features if packed else None)
+        nr_rows = writer.nr_rows
+
+    print(f"Converted {nr_rows} samples.")
+    return outfile
+
+
+class BinaryDataset(object):
+    """Memory-mapped view of a dataset stored in the binary format.
+
+    The dataset is a directory holding the sample ids as fixed-width bytes,
+    the classes as int8 and the features packed eight bits per byte with
+    np.packbits, together with a json file describing the shapes. Nothing is
+    read into memory until rows are accessed.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, BINARY_DATASET_META)) as fin:
+            self.meta = json.load(fin)
+
+        if self.meta['version'] != BINARY_DATASET_VERSION:
+            error_message = f"Unsupported binary dataset version ({self.meta['version']}) of {path}"
+            raise ValueError(error_message)
+
+        self.nr_rows = self.meta['nr_rows']
+        self.nr_features = self.meta['nr_features']
+        self.ids = self._memmap(BINARY_DATASET_IDS, f"S{self.meta['id_width']}", (self.nr_rows,))
+        self.labels = self._memmap(BINARY_DATASET_LABELS, np.int8, (self.nr_rows,))
+        self.features = self._memmap(BINARY_DATASET_FEATURES, np.uint8,
+                                     (self.nr_rows, self.meta['packed_width']))
+
+    def __len__(self):
+        return self.nr_rows
+
+    def _memmap(self, file_name, dtype, shape):
+        if self.nr_rows == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, file_name), dtype=dtype, mode='r', shape=shape)
+
+    def unpack(self, start=0, stop=None):
+        """Returns the features of the rows in [start, stop) as a 0/1 uint8 matrix."""
+        return np.unpackbits(self.features[start:stop], axis=1, count=self.nr_features)
+
+    def to_dataframe(self, start=0, stop=None):
+        columns_names = [str(i) for i in range(1, self.nr_features + 1)]
+        dataframe = pd.DataFrame(self.unpack(start, stop).view(np.int8), columns=columns_names, copy=False)
+        dataframe.insert(0, 'class', np.array(self.labels[start:stop]))
+        dataframe.insert(0, 'id', pd.array(decode_ids(self.ids[start:stop]), dtype='string'))
+        return dataframe
+
+    def to_array(self, data_type='integer'):
+        """Returns the same id and data arrays as read_array, with the class as the first data column."""
+        if data_type == 'integer':
+            dtype = int
+        elif data_type == 'float':
+            dtype = float
+        else:
+            error_message = f"Unsupported data type: {data_type}"
+            raise ValueError(error_message)
+
+        data = np.empty((self.nr_rows, self.nr_features + 1), dtype=dtype)
+        data[:, 0] = self.labels
+        data[:, 1:] = self.unpack()
+        return np.array(self.ids), data
+
+    def iter_dataframes(self, chunksize):
+        return BinaryDatasetReader(self, chunksize)
+
+
+class BinaryDatasetReader(object):
+    """Chunk iterator over a binary dataset, the counterpart of the
+    TextFileReader returned by pd.read_csv when chunking.
+    """
+    def __init__(self, dataset, chunksize):
+        self.dataset = dataset
+        self.chunksize = chunksize
+        self._position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._position >= len(self.dataset):
+            raise StopIteration
+        start = self._position
+        self._position = min(start + self.chunksize, len(self.dataset))
+        return self.dataset.to_dataframe(start, self._position)
+
+
+class BinaryDatasetWriter(object):
+    """Writes a binary dataset incrementally. Classes and packed features are
+    appended to their files as they arrive, while the ids are spooled to a
+    temporary file until the final id width is known.
+    """
+    def __init__(self, outfile):
+        self.path = outfile
+        self.nr_rows = 0
+        self.nr_features = None
+        self.id_width = 1
+        os.makedirs(outfile, exist_ok=True)
+        meta_file = os.path.join(outfile, BINARY_DATASET_META)
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+        self._labels = open(os.path.join(outfile, BINARY_DATASET_LABELS), 'wb')
+        self._features = open(os.path.join(outfile, BINARY_DATASET_FEATURES), 'wb')
+        self._ids_spool = open(os.path.join(outfile, f"{BINARY_DATASET_IDS}.tmp"), 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, ids, labels, features, packed=False, nr_features=None):
+        ids = compact_ids(ids)
+        if ids.size and np.char.find(ids, b'\n').max() >= 0:
+            raise ValueError("Sample ids can't contain newlines")
+
+        if not packed:
+            features = np.asarray(features)
+            if features.size and (features.min() < 0 or features.max() > 1):
+                raise ValueError("The binary dataset format only supports 0/1 features")
+            nr_features = features.shape[1]
+            features = np.packbits(features.astype(np.uint8, copy=False), axis=1)
+        elif nr_features is None:
+            nr_features = self.nr_features
+
+        if nr_features is None:
+            raise ValueError("The number of features must be given for the first packed write")
+        elif self.nr_features is None:
+            self.nr_features = nr_features
+        elif self.nr_features != nr_features:
+            error_message = f"Expected {self.nr_features} features per sample but got {nr_features}"
+            raise ValueError(error_message)
+
+        self.id_width = max(self.id_width, ids.dtype.itemsize)
+        self._ids_spool.write(b'\n'.join(ids.tolist()) + b'\n' if len(ids) else b'')
+        np.asarray(labels, dtype=np.int8).tofile(self._labels)
+        np.ascontiguousarray(features, dtype=np.uint8).tofile(self._features)
+        self.nr_rows += len(ids)
+
+    def write_dataframe(self, dataframe):
+        self.write(compact_ids(dataframe['id']),
+                   dataframe['class'].to_numpy(),
+                   dataframe.iloc[:, 2:].to_numpy(dtype=np.uint8))
+
+    def close(self):
+        if self._ids_spool.closed:
+            return
+
+        self._labels.close()
+        self._features.close()
+        self._ids_spool.close()
+
+        spool_file = os.path.join(self.path, f"{BINARY_DATASET_IDS}.tmp")
+        with open(spool_file, 'rb') as fin, open(os.path.join(self.path, BINARY_DATASET_IDS), 'wb') as fout:
+            while True:
+                lines = fin.readlines(BINARY_DATASET_CHUNKSIZE * 16)
+                if not lines:
+                    break
+                ids = np.array([line.rstrip(b'\n') for line in lines], dtype=f"S{self.id_width}")
+                ids.tofile(fout)
+        os.remove(spool_file)
+
+        if self.nr_features is None:
+            self.nr_features = 0
+        meta = {'version': BINARY_DATASET_VERSION,
+                'nr_rows': self.nr_rows,
+                'nr_features': self.nr_features,
+                'packed_width': (self.nr_features + 7) // 8,
+                'id_width': self.id_width}
+        with open(os.path.join(self.path, BINARY_DATASET_META), 'w') as fout:
+            json.dump(meta, fout)
+
+
+class ResultMerger(object):
+    """Merges the dataframes produced per chunk or per worker. Without an
+    outfile the results are collected and concatenated once at the end, with
+    an outfile every result is appended to it as soon as it arrives, so only
+    one result is held in memory at a time.
+    """
+    def __init__(self, outfile=None, shuffle=True, memory_budget=None):
+        self.outfile = outfile
+        self.shuffle = shuffle
+        self.memory_budget = memory_budget
+        self.nr_rows = 0
+        self._results = []
+        self._writer = None
+        self._fout = None
+        if outfile is not None:
+            print(f"\nStreaming results to {outfile}")
+            if os.path.splitext(outfile)[1] == BINARY_DATASET_EXTENSION:
+                self._writer = BinaryDatasetWriter(outfile)
+            else:
+                self._fout = open(outfile, 'wb')
+
+    def add_fingerprints(self, ids, labels, features, packed=False, nr_features=None):
+        """Adds rows given as arrays, as returned by parse_fingerprints."""
+        if len(ids) == 0:
+            return
+        if self._writer is not None:
+            self.nr_rows += len(ids)
+            self._writer.write(ids, labels, features, packed=packed, nr_features=nr_features)
+            return
+
+        if packed:
+            features = np.unpackbits(features, axis=1, count=nr_features)
+        if self._fout is not None:
+            self.nr_rows += len(ids)
+            self._fout.write(format_fingerprints(ids, labels, features))
+        else:
+            self.add(fingerprints_to_dataframe(ids, labels, features))
+
+    def add(self, dataframe):
+        if dataframe is None or dataframe.empty:
+            return
+        self.nr_rows += len(dataframe)
+        if self._writer is not None:
+            self._writer.write_dataframe(dataframe)
+        elif self._fout is not None:
+            features = dataframe.iloc[:, 2:].to_numpy()
+            if features.size == 0 or (features.min() >= 0 and features.max() <= 1):
+                self._fout.write(format_fingerprints(dataframe['id'], dataframe['class'].to_numpy(), features))
+            else:
+                dataframe.to_csv(self._fout, index=False, header=False, sep='\t', mode='wb')
+        else:
+            self._results.append(dataframe)
+
+    def result(self):
+        """Returns the merged dataframe, or the outfile when streaming."""
+        if self.outfile is None:
+            if not self._results:
+                return pd.DataFrame()
+            dataframe = pd.concat(self._results)
+            self._results = []
+            if self.shuffle:
+                dataframe = shuffle_dataframe(dataframe)
+            return dataframe
+
+        self.close()
+        if self.shuffle:
+            shuffle_file(self.outfile, memory_budget=self.memory_budget)
+        return self.outfile
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._fout is not None:
+            self._fout.close()
+
+
+def shuffle_file(infile, outfile=None, memory_budget=None):
+    """Shuffles the rows of a text or binary dataset into outfile, or in
+    place. Datasets that don't fit into memory_budget (in GB) go through
+    external_shuffle, all others are shuffled holding about one copy of the
+    dataset in memory.
+    """
+    if outfile is None:
+        outfile = infile
+
+    print(f"\nShuffling rows of {infile}")
+    if memory_budget is not None and SHUFFLE_MEMORY_FACTOR * get_dataset_size(infile) > memory_budget * 2 ** 30:
+        return external_shuffle(infile, outfile, memory_budget)
+
+    temp_file = f"{outfile}.tmp-{os.getpid()}"
+    if is_binary_dataset(infile):
+        dataset = BinaryDataset(infile)
+        order = np.random.default_rng().permutation(len(dataset))
+        with BinaryDatasetWriter(temp_file) as writer:
+            for start in range(0, len(dataset), BINARY_DATASET_CHUNKSIZE):
+                rows = order[start:start + BINARY_DATASET_CHUNKSIZE]
+                writer.write(dataset.ids[rows], dataset.labels[rows], dataset.features[rows],
+                             packed=True, nr_features=dataset.nr_features)
+        del dataset
+    else:
+        with open_file(infile) as fin:
+            lines = fin.readlines()
+        if lines and not lines[-1].endswith(b'\n'):
+            lines[-1] += b'\n'
+        order = np.random.default_rng().permutation(len(lines))
+        with open(temp_file, 'wb') as fout:
+            fout.writelines(lines[i] for i in order)
+        del lines
+
+    _replace_dataset(temp_file, outfile)
+    return outfile
+
+
+def external_shuffle(infile, outfile=None, memory_budget=1, temp_dir=None):
+    """Shuffles a dataset that doesn't fit into memory in two passes. The rows
+    are first scattered into randomly chosen bucket files, then every bucket
+    is shuffled in memory and appended to the output. The number of buckets
+    is chosen so that one bucket fits into memory_budget (in GB). The bucket
+    files are kept in temp_dir, which defaults to the directory of outfile.
+    """
+    if outfile is None:
+        outfile = infile
+
+    budget = int(memory_budget * 2 ** 30)
+    nr_buckets = max(1, -(-SHUFFLE_MEMORY_FACTOR * get_dataset_size(infile) // budget))
+    if nr_buckets > MAX_SHUFFLE_BUCKETS:
+        error_message = f"The memory budget of {memory_budget} GB is too small to shuffle {infile}"
+        raise ValueError(error_message)
+
+    print(f"Shuffling externally with {nr_buckets} buckets")
+    if temp_dir is None:
+        temp_dir = os.path.dirname(os.path.abspath(outfile))
+    spill_dir = tempfile.mkdtemp(prefix='.aichemy-shuffle-', dir=temp_dir)
+    bucket_files = [os.path.join(spill_dir, f"bucket{i}") for i in range(nr_buckets)]
+    temp_file = f"{outfile}.tmp-{os.getpid()}"
+    # The scatter pass holds a block and its reordered copy.
+    block_size = max(budget // (2 * SHUFFLE_MEMORY_FACTOR), 1)
+    try:
+        if is_binary_dataset(infile):
+            _external_shuffle_dataset(infile, temp_file, bucket_files, block_size)
+        else:
+            _external_shuffle_lines(infile, temp_file, bucket_files, block_size)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    _replace_dataset(temp_file, outfile)
+    return outfile
+
+
+def _scatter(rows, buckets, rng):
+    """Writes every row of a block to a randomly chosen bucket."""
+    assignment = rng.integers(len(buckets), size=len(rows))
+    order = np.argsort(assignment, kind='stable')
+    counts = np.bincount(assignment, minlength=len(buckets))
+    ends = np.cumsum(counts)
+    for bucket, start, end in zip(buckets, ends - counts, ends):
+        yield bucket, order[start:end]
+
+
+def _external_shuffle_lines(infile, outfile, bucket_files, block_size):
+    rng = np.random.default_rng()
+    buckets = [open(bucket_file, 'wb') for bucket_file in bucket_files]
+    try:
+        with open_file(infile) as fin:
+            while True:
+                lines = fin.readlines(block_size)
+                if not lines:
+                    break
+                if not lines[-1].endswith(b'\n'):
+                    lines[-1] += b'\n'
+                for bucket, rows in _scatter(lines, buckets, rng):
+                    bucket.writelines(lines[i] for i in rows)
+    finally:
+        for bucket in buckets:
+            bucket.close()
+
+    with open(outfile, 'wb') as fout:
+        for bucket_file in bucket_files:
+            with open(bucket_file, 'rb') as fin:
+                lines = fin.readlines()
+            fout.writelines(lines[i] for i in rng.permutation(len(lines)))
+            del lines
+            os.remove(bucket_file)
+
+
+def _external_shuffle_dataset(infile, outfile, bucket_files, block_size):
+    rng = np.random.default_rng()
+    dataset = BinaryDataset(infile)
+    # Every row is spilled as one fixed size record, so the buckets can be read back with np.fromfile.
+    record = np.dtype([('id', dataset.ids.dtype), ('label', np.int8), ('features', np.uint8, dataset.features.shape[1:])])
+    block_rows = max(block_size // record.itemsize, 1)
+
+    buckets = [open(bucket_file, 'wb') for bucket_file in bucket_files]
+    try:
+        for start in range(0, len(dataset), block_rows):
+            stop = min(start + block_rows, len(dataset))
+            records = np.empty(stop - start, dtype=record)
+            records['id'] = dataset.ids[start:stop]
+            records['label'] = dataset.labels[start:stop]
+            records['features'] = dataset.features[start:stop]
+            for bucket, rows in _scatter(records, buckets, rng):
+                records[rows].tofile(bucket)
+    finally:
+        for bucket in buckets:
+            bucket.close()
+
+    with BinaryDatasetWriter(outfile) as writer:
+        for bucket_file in bucket_files:
+            records = np.fromfile(bucket_file, dtype=record)
+            records = records[rng.permutation(len(records))]
+            writer.write(records['id'], records['label'], records['features'],
+                         packed=True, nr_features=dataset.nr_features)
+            del records
+            os.remove(bucket_file)
+    del dataset
+
+
+def _replace_dataset(temp_file, outfile):
+    if os.path.isdir(outfile):
+        shutil.rmtree(outfile)
+    os.replace(temp_file, outfile)
+
+
 def shuffle_dataframe(dataframe):
     return dataframe.sample(frac=1, random_state=randrange(100, 999), axis=0)
 
@@ -0,0 +1,122 @@
+import io
+import os
+import types
+
+import cloudpickle
+import numpy as np
+import pytest
+
+from aichemy.artifact import EnsembleArtifact
+from aichemy.controller import ConfigClf
+from aichemy.models import ModelNN, ModelRNDFOR
+from aichemy.planner import ExecutionPlanner
+from aichemy.postprocessing import read_pred_file
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config')
+NR_FEATURES = 64
+PREDICTION_HEADER = "sampleID\treal_class\tp(0)\tp(1)\n"
+
+
+def write_fingerprints(path, nr_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    features = (rng.random((nr_rows, NR_FEATURES)) < 0.2).astype(np.uint8)
+    labels = (features[:, :4].sum(axis=1) > 0).astype(np.uint8)
+    with open(path, 'w') as fout:
+        for i, (label, row) in enumerate(zip(labels, features)):
+            fout.write(f"S{i}\t{label}\t" + "\t".join(map(str, row)) + "\n")
+    return path
+
+
+def make_controller(tmp_path, mode, infile, classifier_type='nn', **config):
+    args = types.SimpleNamespace(mode=mode, classifier=classifier_type, infile=str(infile), name='test', nr_cores=1,
+                                 models_dir=str(tmp_path / 'models'), outfile=None, outfile2=None,
+                                 pred_files={classifier_type: str(tmp_path / f"pred_{classifier_type}.csv")},
+                                 memory_budget=None)
+    classifier = ConfigClf(classifier_type, os.path.join(CONFIG_DIR, 'classifiers.ini'))
+    if classifier_type == 'nn':
+        classifier.dim_in = NR_FEATURES
+        classifier.dim_hidden = [16]
+        classifier.max_epochs = 2
+    else:
+        classifier.nr_trees = 10
+        classifier.n_jobs = 1
+    for key, value in config.items():
+        setattr(classifier, key, value)
+    return types.SimpleNamespace(args=args, cache=None, planner=ExecutionPlanner(1),
+                                 config=types.SimpleNamespace(classifier=classifier))
+
+
+def check_predictions(path, nr_rows):
+    """Checks the header of a prediction file and that postprocessing reads all of its rows."""
+    with open(path) as fin:
+        assert fin.readline() == PREDICTION_HEADER
+    summary = read_pred_file(str(path), [0.2], 2)
+    assert summary.sum() == nr_rows
+
+
+def pickled_shapes(obj):
+    """Returns the shapes of all numpy arrays pickled with obj, as the artifact pickles it."""
+    shapes = []
+
+    class Pickler(cloudpickle.Pickler):
+        def persistent_id(self, value):
+            if isinstance(value, np.ndarray):
+                shapes.append(value.shape)
+            return None
+
+    Pickler(io.BytesIO()).dump(obj)
+    return shapes
+
+
+def build(tmp_path, nr_rows=600, **config):
+    pytest.importorskip('skorch')
+    pytest.importorskip('libs.nonconformist')
+    infile = write_fingerprints(tmp_path / 'train.txt', nr_rows)
+    os.makedirs(tmp_path / 'models')
+    ModelNN(make_controller(tmp_path, 'build', infile, nr_models=2, **config)).build()
+    return EnsembleArtifact(str(tmp_path / 'models' / 'test_nn.ensemble'))
+
+
+def test_saved_member_does_not_pickle_training_features(tmp_path):
+    nr_rows = 600
+    artifact = build(tmp_path, nr_rows, parallel_nets=1)
+    packed_shape = (nr_rows, NR_FEATURES // 8)
+
+    for i in range(len(artifact)):
+        icp = artifact.load_model(i)
+        adapter = icp.nc_function.model
+        assert icp.cal_x is None
+        assert adapter.last_x is None and adapter.last_y is None
+        assert packed_shape not in pickled_shapes(icp)
+
+
+def test_parallel_build(tmp_path):
+    artifact = build(tmp_path, parallel_nets=2)
+
+    assert len(artifact) == 2
+    assert artifact.has_scripts()
+    for i in range(len(artifact)):
+        assert artifact.load_model(i).nc_function.model.last_x is None
+
+    test_file = write_fingerprints(tmp_path / 'test.txt', 50, seed=1)
+    ModelNN(make_controller(tmp_path, 'predict', test_file, nr_models=2)).predict()
+    check_predictions(tmp_path / 'pred_nn.csv', 50)
+
+
+def test_forest_members_are_separate_estimators(tmp_path):
+    infile = write_fingerprints(tmp_path / 'train.txt', 300)
+    os.makedirs(tmp_path / 'models')
+    model = ModelRNDFOR(make_controller(tmp_path, 'build', infile, 'rndfor', nr_models=3, parallel_models=1))
+    model.build()
+
+    test_data = (np.random.default_rng(1).random((50, NR_FEATURES)) < 0.2).astype(np.uint8)
+    built = model.load_models()
+    loaded = EnsembleArtifact(model.artifact.path).load_models()
+    assert len({id(member) for member in built}) == 3
+    for built_member, loaded_member in zip(built, loaded):
+        np.testing.assert_array_equal(built_member.predict_proba(test_data), loaded_member.predict_proba(test_data))
+    assert not np.array_equal(built[0].predict_proba(test_data), built[1].predict_proba(test_data))
+
+    test_file = write_fingerprints(tmp_path / 'test.txt', 50, seed=1)
+    ModelRNDFOR(make_controller(tmp_path, 'predict', test_file, 'rndfor', nr_models=3)).predict()
+    check_predictions(tmp_path / 'pred_rndfor.csv', 50)
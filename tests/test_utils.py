@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from aichemy.dataset import AIchemyDataset
+from aichemy.utils import parse_fingerprints, parse_labels, read_fingerprints
+
+LINES = [b"S0\t1\t0\t1\t1", b"S1\t0\t1\t0\t0", b"S22 2 1 1 0"]
+
+
+@pytest.mark.parametrize('buffer', [
+    b"\n".join(LINES) + b"\n",
+    b"\n".join(LINES),
+    b"\r\n".join(LINES) + b"\r\n",
+    b"\n\n" + b"\n\r\n".join(LINES) + b"\n\n",
+])
+def test_labels_and_fingerprints_split_lines_alike(buffer):
+    ids, labels, features = parse_fingerprints(buffer)
+
+    assert ids.tolist() == [b'S0', b'S1', b'S22']
+    np.testing.assert_array_equal(features, [[0, 1, 1], [1, 0, 0], [1, 1, 0]])
+    np.testing.assert_array_equal(labels, [1, 0, 2])
+    np.testing.assert_array_equal(parse_labels(buffer), labels)
+
+
+@pytest.mark.parametrize('buffer', [b"", b"\n", b"\r\n\n"])
+def test_empty_buffers(buffer):
+    assert parse_fingerprints(buffer) is None
+    assert parse_labels(buffer).size == 0
+
+
+@pytest.mark.parametrize('separator', ['\t', '  '])
+def test_read_packed_fingerprints(tmp_path, separator):
+    features = (np.random.default_rng(0).random((40, 13)) < 0.3).astype(np.uint8)
+    path = tmp_path / 'fingerprints.txt'
+    with open(path, 'w') as fout:
+        for i, row in enumerate(features):
+            fout.write(separator.join([f"S{i}", str(i % 3)] + [str(bit) for bit in row]) + "\n")
+
+    ids, labels, packed_features, nr_features = read_fingerprints(str(path), packed=True)
+    assert nr_features == 13
+    np.testing.assert_array_equal(packed_features, np.packbits(features, axis=1))
+    np.testing.assert_array_equal(labels, np.arange(40) % 3)
+
+    dataset = AIchemyDataset.from_file(str(path), packed=True)
+    assert dataset.packed and dataset.nr_features == 13
+    np.testing.assert_array_equal(dataset.get_features(), features)